@@ -1,8 +1,6 @@
-from PIL import Image
+from PIL import Image, ImageColor
 import torch
 import numpy as np
-from .inspyrenet import Remover
-from tqdm import tqdm
 
 
 def tensor2pil(image):
@@ -21,7 +19,13 @@ class InspyrenetRembgLoader:
         return {
             "required": {
                 "mode": (["base", "fast"],),
-                "torchscript_jit": (["default", "on"],),
+                "torchscript_jit": (["default", "on", "bucketed", "compile"],),
+            },
+            "optional": {
+                "precision": (["fp32", "bf16", "fp16", "int8"],),
+                "cpu_workers": ("INT", {"default": 0, "min": 0, "max": 64, "step": 1}),
+                "channels_last": (["off", "on"],),
+                "latency_calibration": (["on first use", "on load"],),
             },
         }
 
@@ -29,9 +33,20 @@ class InspyrenetRembgLoader:
     FUNCTION = "load_model"
     CATEGORY = "image"
 
-    def load_model(self, mode, torchscript_jit):
-        jit = torchscript_jit == "on"
-        self.model = Remover(mode=mode, jit=jit)
+    def load_model(self, mode, torchscript_jit, precision="fp32", cpu_workers=0, channels_last="off",
+                   latency_calibration="on first use"):
+        # bucketed / compile keep one traced or compiled model per resolution bucket instead of a single square size
+        jit = {"default": False, "on": True}.get(torchscript_jit, torchscript_jit)
+        # The InSPyReNet stack (Swin backbone, kornia, gdown, ...) is imported on first use so the plugin loads fast
+        from .inspyrenet import registry
+
+        # Models are shared process-wide, so re-running the loader after a workflow edit reuses the live instance
+        # cpu_workers > 1 splits every batch across worker processes with their own thread budget, for cpu only hosts
+        # batch norms are always folded into the convs at load, channels_last additionally keeps feature maps in NHWC
+        self.model = registry.get(mode=mode, jit=jit, precision=precision, workers=cpu_workers, channels_last=channels_last == "on")
+        if latency_calibration == "on load":
+            # latency_budget_ms of the process nodes then never pays for the calibration, the fit is cached on disk
+            self.model.calibrate()
         return (self.model,)
 
 class InspyrenetRembgProcess:
@@ -44,50 +59,145 @@ class InspyrenetRembgProcess:
                 "threshold": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.01}),
                 "background_color": ("STRING", {"default": "", "multiline": False}),
             },
+            "optional": {
+                "batch_size": ("INT", {"default": 8, "min": 1, "max": 256, "step": 1}),
+                "tile_size": ("INT", {"default": 0, "min": 0, "max": 4096, "step": 32}),
+                "temporal": (["off", "on"],),
+                "keyframe_interval": ("INT", {"default": 30, "min": 1, "max": 1000, "step": 1}),
+                "change_threshold": ("FLOAT", {"default": 0.02, "min": 0.0, "max": 1.0, "step": 0.005}),
+                "smoothing": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 0.99, "step": 0.01}),
+                "matte_cache": (["off", "on"],),
+                "latency_budget_ms": ("INT", {"default": 0, "min": 0, "max": 60000, "step": 50}),
+            },
         }
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "process_image"
     CATEGORY = "image"
 
-    def process_image(self, model, image, threshold, background_color):
-        img_list = []
-        mask_list = []  # New mask list
-        for img in tqdm(image, "Inspyrenet Rembg"):
-            mid = model.process(tensor2pil(img), type='rgba', threshold=threshold)
-
-            # Save mask (before applying background)
-            rgba_tensor = pil2tensor(mid)
-            mask_list.append(rgba_tensor[:, :, :, 3])  # Save alpha channel as mask
-
-            if background_color.strip():
-                try:
-                    rgba_img = mid
-                    background = Image.new('RGBA', rgba_img.size, background_color)
-                    mid = Image.alpha_composite(background, rgba_img)
-                    # Convert to RGB mode, removing alpha channel
-                    mid = mid.convert('RGB')
-                except ValueError:
-                    print(f"Invalid color value: {background_color}, using transparent background")
-
-            out = pil2tensor(mid)
-            img_list.append(out)
-
-        img_stack = torch.cat(img_list, dim=0)
-        mask_stack = torch.cat(mask_list, dim=0)  # Combine all masks
-
-        # Return RGB image and mask if background color is specified
+    def process_image(self, model, image, threshold, background_color, batch_size=8, tile_size=0,
+                      temporal="off", keyframe_interval=30, change_threshold=0.02, smoothing=0.0, matte_cache="off",
+                      latency_budget_ms=0):
+        type = 'rgba'
         if background_color.strip():
-            return (img_stack[:, :, :, :3], mask_stack)
-        # If no background color, keep original RGBA format
+            try:
+                type = list(ImageColor.getrgb(background_color)[:3])
+            except ValueError:
+                print(f"Invalid color value: {background_color}, using transparent background")
+
+        # Frames are grouped by network input size and forwarded batch_size at a time,
+        # the alpha matte and the composited image stay tensors all the way
+        # tile_size > 0 mattes at full resolution with bounded memory instead of capping the short side at 1280,
+        # 0 keeps the widget minimum for off, so tiles below 384 are rejected by the model instead
+        # latency_budget_ms > 0 picks the largest input size this host forwards within the budget per image
+        latency = latency_budget_ms or None
+        if temporal == "on":
+            # The batch is a video clip: only keyframes and frames that changed enough are inferred,
+            # near static frames reuse the matte of the last inferred frame
+            img_stack, mask_stack, keys = model.process_frames(image, type=type, threshold=threshold, batch_size=batch_size,
+                                                               tile_size=tile_size or None, keyframe_interval=keyframe_interval,
+                                                               change_threshold=change_threshold, smoothing=smoothing,
+                                                               latency=latency)
+            print(f"InSPyReNet temporal -> inferred {len(keys)} of {len(image)} frames")
+        elif matte_cache == "on":
+            # Soft predictions are cached on disk by image content and model, before threshold and background
+            # are applied, so repeat inputs skip the forward pass even when those settings change
+            from .inspyrenet import matte_cache as cache
+
+            preds = cache.predict(model, image, batch_size=batch_size, tile_size=tile_size or None, latency=latency)
+            img_stack, mask_stack = model.process_preds(image, preds, type=type, threshold=threshold, batch_size=batch_size)
+            print(f"InSPyReNet matte cache -> {cache.stats()}")
+        else:
+            img_stack, mask_stack = model.process_batch(image, type=type, threshold=threshold, batch_size=batch_size,
+                                                        tile_size=tile_size or None, latency=latency)
+
+        # RGB image if a background color is applied, otherwise RGBA
+        return (img_stack, mask_stack)
+
+class InspyrenetRembgPredict:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "model": ("INSPYRENET_MODEL",),
+                "image": ("IMAGE",),
+            },
+            "optional": {
+                "batch_size": ("INT", {"default": 8, "min": 1, "max": 256, "step": 1}),
+                "tile_size": ("INT", {"default": 0, "min": 0, "max": 4096, "step": 32}),
+                "matte_cache": (["off", "on"],),
+                "latency_budget_ms": ("INT", {"default": 0, "min": 0, "max": 60000, "step": 50}),
+            },
+        }
+
+    RETURN_TYPES = ("MASK",)
+    RETURN_NAMES = ("saliency_map",)
+    FUNCTION = "predict"
+    CATEGORY = "image"
+
+    def predict(self, model, image, batch_size=8, tile_size=0, matte_cache="off", latency_budget_ms=0):
+        # Only the network runs here, so ComfyUI keeps this output cached while
+        # threshold or background change on the composite node downstream
+        if matte_cache == "on":
+            from .inspyrenet import matte_cache as cache
+
+            preds = cache.predict(model, image, batch_size=batch_size, tile_size=tile_size or None, latency=latency_budget_ms or None)
+            print(f"InSPyReNet matte cache -> {cache.stats()}")
         else:
-            return (img_stack, mask_stack)
+            preds = model.predict(image, batch_size=batch_size, tile_size=tile_size or None, latency=latency_budget_ms or None)
+        return (preds,)
+
+class InspyrenetRembgComposite:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "model": ("INSPYRENET_MODEL",),
+                "image": ("IMAGE",),
+                "saliency_map": ("MASK",),
+                "threshold": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "background": (["transparent", "color", "image", "blur", "overlay", "map"],),
+                "background_color": ("STRING", {"default": "", "multiline": False}),
+            },
+            "optional": {
+                "refine": (["on", "off"],),
+                "background_image": ("IMAGE",),
+                "batch_size": ("INT", {"default": 8, "min": 1, "max": 256, "step": 1}),
+            },
+        }
+
+    RETURN_TYPES = ("IMAGE", "MASK")
+    FUNCTION = "composite"
+    CATEGORY = "image"
+
+    def composite(self, model, image, saliency_map, threshold, background, background_color, refine="on", background_image=None,
+                  batch_size=8):
+        type = {"transparent": "rgba", "blur": "blur", "overlay": "overlay", "map": "map"}.get(background)
+        if background == "color":
+            try:
+                type = list(ImageColor.getrgb(background_color)[:3])
+            except ValueError:
+                print(f"Invalid color value: {background_color}, using transparent background")
+                type = 'rgba'
+        elif background == "image":
+            if background_image is None:
+                raise ValueError("background_image is required for the image background.")
+            type = background_image
+
+        # Threshold edge blending and compositing only, the model is used for its device
+        img_stack, mask_stack = model.process_preds(image, saliency_map, type=type, threshold=threshold if refine == "on" else None,
+                                                    batch_size=batch_size)
+        return (img_stack, mask_stack)
 
 NODE_CLASS_MAPPINGS = {
     "InspyrenetRembgLoader": InspyrenetRembgLoader,
-    "InspyrenetRembgProcess": InspyrenetRembgProcess
+    "InspyrenetRembgProcess": InspyrenetRembgProcess,
+    "InspyrenetRembgPredict": InspyrenetRembgPredict,
+    "InspyrenetRembgComposite": InspyrenetRembgComposite,
 }
 NODE_DISPLAY_NAME_MAPPINGS = {
     "InspyrenetRembgLoader": "InSPyReNet Loader",
-    "InspyrenetRembgProcess": "InSPyReNet Rembg"
+    "InspyrenetRembgProcess": "InSPyReNet Rembg",
+    "InspyrenetRembgPredict": "InSPyReNet Predict",
+    "InspyrenetRembgComposite": "InSPyReNet Refine & Composite",
 }
@@ -125,28 +125,101 @@ class InSPyReNet(nn.Module):
                 
             # HR Saliency Pyramid
             hr_out = self.forward_inspyre(img)
-            hr_d3, hr_d2, hr_d1, hr_d0 = hr_out['saliency']
-            hr_p2, hr_p1, hr_p0      = hr_out['laplacian']
+            d0 = self.pyramid_blend(lr_d0, hr_out)
             
-            # Pyramid Blending
-            d3 = self.ret(lr_d0, hr_d3) 
-            
-            t2 = self.ret(self.transition2(d3), hr_p2)
-            p2 = t2 * hr_p2
-            d2 = self.image_pyramid.reconstruct(d3, p2)
-            
-            t1 = self.ret(self.transition1(d2), hr_p1)
-            p1 = t1 * hr_p1
-            d1 = self.image_pyramid.reconstruct(d2, p1)
+        return self.normalize(d0)
+    
+    def pyramid_blend(self, lr_d0, hr_out):
+        hr_d3, hr_d2, hr_d1, hr_d0 = hr_out['saliency']
+        hr_p2, hr_p1, hr_p0      = hr_out['laplacian']
+        
+        # Pyramid Blending
+        d3 = self.ret(lr_d0, hr_d3) 
+        
+        t2 = self.ret(self.transition2(d3), hr_p2)
+        p2 = t2 * hr_p2
+        d2 = self.image_pyramid.reconstruct(d3, p2)
+        
+        t1 = self.ret(self.transition1(d2), hr_p1)
+        p1 = t1 * hr_p1
+        d1 = self.image_pyramid.reconstruct(d2, p1)
+        
+        t0 = self.ret(self.transition0(d1), hr_p0)
+        p0 = t0 * hr_p0
+        d0 = self.image_pyramid.reconstruct(d1, p0)
+        
+        return d0
+    
+    def forward_tiled(self, img, img_lr, tile_size=1024, overlap=128):
+        """
+        Args:
+            img (torch.Tensor): high resolution input of shape [B, 3, H, W], H and W must be multiples of 32
+            img_lr (torch.Tensor): low resolution input of the whole image, usually resized to base_size
+            tile_size (int): size of the square tiles forwarded through the HR pyramid, multiple of 32
+            overlap (int): overlap between neighboring tiles, feathered linearly to hide the seams
+        Returns:
+            torch.Tensor: normalized prediction of shape [B, 1, H, W]. peak memory depends on tile_size, not on H and W.
+        """
+        B, _, H, W = img.shape
+        lr_d0 = self.forward_inspyre(img_lr)['saliency'][-1]
+        
+        d0 = img.new_zeros(B, 1, H, W)
+        weight = img.new_zeros(1, 1, H, W)
+        
+        for top, left, h, w in tile_grid(H, W, tile_size, overlap):
+            hr_out = self.forward_inspyre(img[:, :, top:top + h, left:left + w])
             
-            t0 = self.ret(self.transition0(d1), hr_p0)
-            p0 = t0 * hr_p0
-            d0 = self.image_pyramid.reconstruct(d1, p0)
+            # LR saliency of the tile region, sampled to the coarsest HR stage
+            theta = img.new_tensor([[w / W, 0, (2 * left + w) / W - 1],
+                                    [0, h / H, (2 * top + h) / H - 1]]).expand(B, 2, 3)
+            grid = F.affine_grid(theta, (B, 1, *hr_out['saliency'][0].shape[-2:]), align_corners=False)
+            lr = F.grid_sample(lr_d0, grid, mode='bilinear', align_corners=False)
             
+            f = feather(top, left, h, w, H, W, overlap).to(img)
+            d0[:, :, top:top + h, left:left + w] += self.pyramid_blend(lr, hr_out) * f
+            weight[:, :, top:top + h, left:left + w] += f
+            del hr_out
+        
+        return self.normalize(d0 / weight)
+    
+    @float32
+    def normalize(self, d0):
+        B = d0.shape[0]
         pred = torch.sigmoid(d0)
-        pred = (pred - pred.min()) / (pred.max() - pred.min() + 1e-8)
+        
+        # normalize each sample on its own so that batched results match single image inference
+        pred_min = pred.flatten(1).min(dim=1)[0].view(B, 1, 1, 1)
+        pred_max = pred.flatten(1).max(dim=1)[0].view(B, 1, 1, 1)
+        pred = (pred - pred_min) / (pred_max - pred_min + 1e-8)
 
         return pred
     
+def tile_grid(H, W, tile_size, overlap):
+    if overlap >= tile_size:
+        raise ValueError("tile overlap ({}) must be smaller than tile_size ({}).".format(overlap, tile_size))
+
+    def starts(L):
+        if L <= tile_size:
+            return [0]
+        stride = tile_size - overlap
+        s = list(range(0, L - tile_size, stride))
+        return s + [L - tile_size]
+    
+    return [(top, left, min(tile_size, H), min(tile_size, W)) for top in starts(H) for left in starts(W)]
+
+def feather(top, left, h, w, H, W, overlap):
+    def ramp(start, length, L):
+        r = torch.ones(length)
+        n = min(overlap, length // 2)
+        if n > 0:
+            up = torch.arange(1, n + 1, dtype=torch.float32) / (n + 1)
+            if start > 0:
+                r[:n] = up
+            if start + length < L:
+                r[-n:] = torch.minimum(r[-n:], up.flip(0))
+        return r
+    
+    return (ramp(top, h, H)[:, None] * ramp(left, w, W)[None, :]).view(1, 1, h, w)
+
 def InSPyReNet_SwinB(depth, pretrained, base_size, **kwargs):
     return InSPyReNet(SwinB(pretrained=pretrained), [128, 128, 256, 512, 1024], depth, base_size, **kwargs)
\ No newline at end of file
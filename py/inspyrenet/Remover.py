@@ -1,22 +1,29 @@
 import os
 import sys
+import json
+import math
+import time
 import tqdm
+import queue
 import wget
 import gdown
 import torch
 import shutil
 import base64
+import hashlib
 import warnings
+import platform
+import contextlib
 import importlib
+import itertools
 
 import numpy as np
 import torch.nn.functional as F
-import torchvision.transforms as transforms
-import albumentations as A
-import albumentations.pytorch as AP
 
 from PIL import Image
 from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from packaging import version
 from easydict import EasyDict
 
@@ -25,20 +32,37 @@ repopath = os.path.split(filepath)[0]
 sys.path.append(repopath)
 
 from .InSPyReNet import InSPyReNet_SwinB
+from .modules.layers import fuse_conv_bn
 from .utils import *
+from .refine import refine
+from .compositor import Compositor
 
 class Remover:
-    def __init__(self, mode="base", jit=False, device=None, ckpt=None, fast=None):
+    def __init__(self, mode="base", jit=False, device=None, ckpt=None, fast=None, precision="fp32", precast=False, fuse=True,
+                 channels_last=False, calibrate=False):
         """
         Args:
             mode   (str): Choose among below options
                                    base -> slow & large gpu memory required, high quality results
                                    fast -> resize input into small size for fast computation
                                    base-nightly -> nightly release for base mode
-            jit    (bool): use TorchScript for fast computation
+            jit    (bool or str): use TorchScript for fast computation
+                                   True -> trace once at base_size and resize every input to it
+                                   bucketed -> snap inputs to a fixed set of resolution buckets and trace each bucket on first use, traces are cached on disk
+                                   compile -> same buckets, compiled with torch.compile on first use. up to COMPILE_CACHE_SIZE
+                                              bucket and batch size pairs are compiled, the others run eagerly with a warning
             device (str, optional): specifying device for computation. find available GPU resource if not specified.
             ckpt   (str, optional): specifying model checkpoint. find downloaded checkpoint or try download if not specified.
             fast   (bool, optional, DEPRECATED): replaced by mode argument. use fast mode if True.
+            precision (str): fp32, bf16, fp16 or int8. bf16 and fp16 run the model under autocast, falls back to fp32 where not supported.
+                             image pyramid, transition and the final normalization always stay in fp32.
+                             int8 dynamically quantizes the Linear layers of the model for cpu inference.
+            precast (bool): keep conv and linear weights pre-cast to the bf16 / fp16 precision instead of casting them on every forward.
+                            halves weight memory. not available with TorchScript traces, which run outside of autocast.
+            fuse (bool): fold batch norms into the preceding convs at load. the folded weights are cached next to the checkpoint.
+            channels_last (bool): keep the model and its inputs in channels last memory format, faster convs on tensor core gpus and some cpus.
+            calibrate (bool): measure the latency cost model for latency budgets now, instead of on the first budgeted request.
+                              a cost model cached by an earlier calibration is always loaded.
         """
         cfg_path = os.environ.get('TRANSPARENT_BACKGROUND_FILE_PATH', os.path.abspath(os.path.expanduser('~')))
         home_dir = os.path.join(cfg_path, ".transparent-background")
@@ -53,17 +77,12 @@ class Remover:
             if fast:
                 mode = "fast"
 
-        if device is not None:
-            self.device = device
-        else:
-            self.device = "cpu"
-            if torch.cuda.is_available():
-                self.device = "cuda:0"
-            elif (
-                version.parse(torch.__version__) >= version.parse("1.13")
-                and torch.backends.mps.is_available()
-            ):
-                self.device = "mps:0"
+        self.device = get_device(device)
+        if precision == "int8" and torch.device(self.device).type != "cpu":
+            warnings.warn("int8 is only supported on cpu, using fp32 on {} instead.".format(self.device))
+            precision = "fp32"
+        self.precision = precision
+        self.autocast_dtype = get_autocast_dtype(precision, self.device)
 
         download = False
         if ckpt is None:
@@ -74,9 +93,7 @@ class Remover:
                 download = True
             elif (
                 self.meta.md5
-                != hashlib.md5(
-                    open(os.path.join(ckpt_dir, ckpt_name), "rb").read()
-                ).hexdigest()
+                != get_md5(os.path.join(ckpt_dir, ckpt_name), cache_dir=home_dir)
             ):
                 if self.meta.md5 is not None:
                     download = True
@@ -93,15 +110,53 @@ class Remover:
 
         self.model = InSPyReNet_SwinB(depth=64, pretrained=False, threshold=None, **self.meta)
         self.model.eval()
-        self.model.load_state_dict(
-            torch.load(os.path.join(ckpt_dir, ckpt_name), map_location="cpu"),
-            strict=True,
-        )
+        if precision == "int8":
+            self.model = quantize_dynamic(self.model, os.path.join(ckpt_dir, ckpt_name))
+            if fuse:
+                fuse_conv_bn(self.model)
+        else:
+            if precast and (self.autocast_dtype is None or jit in (True, "bucketed")):
+                warnings.warn("precast requires bf16 or fp16 precision without TorchScript, loading fp32 weights instead.")
+                precast = False
+
+            if fuse:
+                # only the layout of the folded model is needed here, its weights come from the folded checkpoint
+                fuse_conv_bn(self.model)
+
+            # weights are memory-mapped from a converted copy of the checkpoint, and assigned without
+            # another copy where supported, so peak memory during load stays close to the model size
+            self.model.load_state_dict(
+                load_weights(os.path.join(ckpt_dir, ckpt_name), dtype=self.autocast_dtype if precast else None, fuse=fuse),
+                strict=True,
+                **({"assign": True} if version.parse(torch.__version__) >= version.parse("2.1") else {}),
+            )
         self.model = self.model.to(self.device)
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        self.fuse = fuse
+        self.channels_last = channels_last
+        # traces of folded and channels last models are cached apart from the plain ones
+        self.variant = "{}{}{}".format("_int8" if precision == "int8" else "", "_fused" if fuse else "", "_cl" if channels_last else "")
+        self.ckpt = os.path.join(ckpt_dir, ckpt_name)
+        self.artifacts = {}
+        self.compiled = set()
+
+        if jit == "compile":
+            if 'TORCHINDUCTOR_CACHE_DIR' not in os.environ:
+                # keep compiled kernels next to the checkpoints so they survive restarts
+                os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(home_dir, "inductor")
 
-        if jit:
+            # every bucket recompiles the same forward_inference code, and dynamo runs it eagerly without a word
+            # once its cache limit (8 by default) is hit. the limit is raised to the shapes compiled in get_model
+            import torch._dynamo
+
+            for name in ("cache_size_limit", "accumulated_cache_size_limit"):
+                if hasattr(torch._dynamo.config, name):
+                    setattr(torch._dynamo.config, name, max(getattr(torch._dynamo.config, name), COMPILE_CACHE_SIZE))
+
+        if jit is True:
             ckpt_name = self.meta.ckpt_name.replace(
-                ".pth", "_{}.pt".format(self.device)
+                ".pth", "_{}{}.pt".format(self.device, self.variant)
             )
             try:
                 traced_model = torch.jit.load(
@@ -119,38 +174,22 @@ class Remover:
                 self.model = traced_model
                 torch.jit.save(self.model, os.path.join(ckpt_dir, ckpt_name))
 
-        self.transform = transforms.Compose(
-            [
-                static_resize(self.meta.base_size)
-                if jit
-                else static_resize(size=[384, 384])
-                if 'fast' in mode
-                else dynamic_resize(L=1280),
-                tonumpy(),
-                normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-                totensor(),
-            ]
-        )
-
-        self.cv2_transform = A.Compose(
-            [
-                A.Resize(*self.meta.base_size)
-                if jit
-                else A.Resize(384, 384)
-                if 'fast' in mode
-                else dynamic_resize_a(L=1280),
-                A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-                AP.ToTensorV2(),
-            ]
-        )
-
-        self.background = {'img': None, 'name': None, 'shape': None}
-        desc = "Mode={}, Device={}, Torchscript={}".format(
-            mode, self.device, "enabled" if jit else "disabled"
+        self.mode = mode
+        self.jit = jit
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=self.device).view(1, 3, 1, 1)
+        self.compositor = Compositor()
+        # 'fast' forwards at 384x384 regardless of the mode, switched at runtime by a LatencyController
+        self.sizing = None
+        self.home_dir = home_dir
+        self.cost_model = None
+        desc = "Mode={}, Device={}, Torchscript={}, Precision={}, Fused={}, ChannelsLast={}".format(
+            mode, self.device, jit if isinstance(jit, str) else "enabled" if jit else "disabled", precision, fuse, channels_last
         )
         print("Settings -> {}".format(desc))
+        self.calibrate(measure=calibrate)
 
-    def process(self, img, type="rgba", threshold=None):
+    def process(self, img, type="rgba", threshold=None, latency=None):
         """
         Args:
             img (PIL.Image or np.ndarray): input image as PIL.Image or np.ndarray type
@@ -163,139 +202,455 @@ class Remover:
                         'overlay' will cover the salient object with translucent green color, and highlight the edges.
                         Another image file (e.g., 'samples/backgroud.png') will be used as a background, and the object will be overlapped on it.
             threshold (float or str, optional): produce hard prediction w.r.t specified threshold value (0.0 ~ 1.0)
+            latency (float, optional): latency budget per image in milliseconds, see `get_budget_size`
         Returns:
             PIL.Image: output image
 
         """
 
-        if isinstance(img, np.ndarray):
-            is_numpy = True
-            shape = img.shape[:2]
-            x = self.cv2_transform(image=img)["image"]
+        is_numpy = isinstance(img, np.ndarray)
+        img = np.array(img)
+
+        # composition runs on the uint8 image in fixed point, like the output
+        x = torch.from_numpy(img).to(self.device).unsqueeze(0)
+        pred = self.predict(x.float().div(255), latency=latency)
+        img, _ = self.process_preds(x, pred, type=type, threshold=threshold)
+        img = img[0].cpu().numpy()
+
+        if is_numpy:
+            return img
         else:
-            is_numpy = False
-            shape = img.size[::-1]
-            x = self.transform(img)
-
-        x = x.unsqueeze(0)
-        x = x.to(self.device)
-
-        with torch.no_grad():
-            pred = self.model(x)
-
-        pred = F.interpolate(pred, shape, mode="bilinear", align_corners=True)
-        pred = pred.data.cpu()
-        pred = pred.numpy().squeeze()
-
-        if threshold is not None:
-            # 保存原始预测值
-            original_pred = pred.copy()
-            
-            # 降低阈值以保留更多细节
-            binary_pred = (pred > float(threshold) * 0.8).astype(np.float64)  # 降低阈值
-            
-            # 多尺度边缘检测 - 使用更小的kernel以保留细节
-            kernels = [(3,3), (5,5)]  # 减少kernel大小
-            edge_regions = []
-            
-            for k_size in kernels:
-                kernel = np.ones(k_size, np.uint8)
-                dilated = cv2.dilate(binary_pred, kernel)
-                eroded = cv2.erode(binary_pred, kernel)
-                edge_region = dilated - eroded
-                edge_regions.append(edge_region)
-            
-            # 融合多尺度边缘
-            edge_region = np.maximum.reduce(edge_regions)
-            
-            # 计算结构相似度权重 - 减小模糊程度
-            structure_weight = cv2.GaussianBlur(original_pred, (0, 0), sigmaX=0.5)  # 减小sigma
-            
-            # 边缘区域的自适应blend
-            blend_mask = cv2.GaussianBlur(edge_region, (0, 0), sigmaX=1.0)  # 减小sigma
-            blend_mask = blend_mask * structure_weight
-            
-            # 使用更温和的sigmoid过渡
-            alpha = 5.0  # 降低alpha值使过渡更平滑
-            blend_mask = 1 / (1 + np.exp(-alpha * (blend_mask - 0.3)))  # 调整偏移值
-            
-            # 在边缘区域使用加权融合，保留更多原始预测值
-            pred = binary_pred * 0.7 + original_pred * 0.3  # 添加原始预测值的权重
-            pred = pred * (1 - blend_mask) + original_pred * blend_mask
-            
-            # 应用结构保持滤波 - 使用更大的半径
-            guide = (original_pred * 255).astype(np.uint8)
-            pred = (pred * 255).astype(np.uint8)
-            guided_filter = cv2.ximgproc.createGuidedFilter(guide, 5, 1e-2)  # 增加半径和epsilon
-            pred = guided_filter.filter(pred)
-            pred = pred.astype(np.float64) / 255.0
-            
-            # 最后的调整以确保主体被保留
-            pred = np.maximum(pred, original_pred * 0.5)  # 确保原始预测值的一定比例被保留
-            
-            # 确保值在 0-1 范围内
-            pred = np.clip(pred, 0, 1)
+            return Image.fromarray(img)
 
-        img = np.array(img)
+    def get_size(self, shape, tile_size=None, latency=None):
+        """
+        Args:
+            shape (tuple): height and width of the input image
+            tile_size (int, optional): tiled inference keeps the full resolution, only rounded to multiples of 32
+            latency (float, optional): latency budget per image in milliseconds, see `get_budget_size`
+        Returns:
+            tuple: height and width of the network input, which is used as a bucket key for batched inference
+        """
+        if tile_size:
+            return get_dynamic_size(shape, L=max(shape))
+        elif self.jit is True:
+            return tuple(self.meta.base_size)
+        elif 'fast' in self.mode or self.sizing == 'fast':
+            return (384, 384)
+        elif latency:
+            return self.get_budget_size(shape, latency)
+        elif self.jit in ("bucketed", "compile"):
+            return get_bucket_size(get_dynamic_size(shape, L=1280))
+        else:
+            return get_dynamic_size(shape, L=1280)
 
-        if type.startswith("["):
-            type = [int(i) for i in type[1:-1].split(",")]
+    def get_budget_size(self, shape, latency):
+        """
+        Args:
+            shape (tuple): height and width of the input image
+            latency (float): latency budget per image in milliseconds
+        Returns:
+            tuple: largest network input within the budget w.r.t the cost model of this host, keeping the aspect ratio.
+                   sizes are snapped down to the bucket grid (see `get_bucket_size`) so no budget is spent on window padding,
+                   and never exceed the default size of the mode. if the budget is below the smallest bucket, the short side
+                   stays at the smallest bucket and the long side is scaled with it.
+        """
+        if self.cost_model is None:
+            warnings.warn("latency cost model is not calibrated, calibrating now. use calibrate=True to calibrate at load.")
+        fixed, per_mp = self.cost_model or self.calibrate()
+        size = self.get_size(shape)
+        pixels = max(latency - fixed, 0) / per_mp * 1e6
+        scale = math.sqrt(pixels / (size[0] * size[1]))
+        if scale >= 1:
+            return size
+        scale = max(scale, BUCKET_SIZES[0] / min(size))
+        return tuple(max([b for b in BUCKET_SIZES if b <= s * scale] or BUCKET_SIZES[:1]) for s in size)
 
-        if type == "map":
-            img = (np.stack([pred] * 3, axis=-1) * 255).astype(np.uint8)
+    def calibrate(self, sizes=(384, 768, 1152), repeat=2, measure=True):
+        """
+        Fits the latency of a single image on this host as a linear function of the number of input pixels. the fit is cached
+        in the home directory per host, device, thread count, mode, precision, TorchScript option and torch version, so it runs once.
 
-        elif type == "rgba":
-            r, g, b = cv2.split(img)
-            pred = (pred * 255).astype(np.uint8)
-            img = cv2.merge([r, g, b, pred])
+        Args:
+            sizes (tuple): square input sizes to measure
+            repeat (int): measurements per size, the fastest one is used
+            measure (bool): measure if there is no cached fit, otherwise only the cached fit is loaded
+        Returns:
+            tuple: fixed cost in milliseconds and cost per megapixel in milliseconds, None if not cached and not measured
+        """
+        if self.cost_model is not None:
+            return self.cost_model
 
-        elif type == "green":
-            bg = np.stack([np.ones_like(pred)] * 3, axis=-1) * [120, 255, 155]
-            img = img * pred[..., np.newaxis] + bg * (1 - pred[..., np.newaxis])
+        path = os.path.join(self.home_dir, "cost_model.json")
+        key = ":".join(map(str, (platform.node(), self.device, torch.get_num_threads(), self.mode, self.precision, self.jit, self.variant, torch.__version__)))
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
 
-        elif type == "white":
-            bg = np.stack([np.ones_like(pred)] * 3, axis=-1) * [255, 255, 255]
-            img = img * pred[..., np.newaxis] + bg * (1 - pred[..., np.newaxis])
+        if key not in cache and not measure:
+            return None
+        elif key not in cache:
+            device = torch.device(self.device)
+            sync = getattr(torch, device.type).synchronize if device.type in ("cuda", "mps") else lambda: None
 
-        elif len(type) == 3:
-            print(type)
-            bg = np.stack([np.ones_like(pred)] * 3, axis=-1) * type
-            img = img * pred[..., np.newaxis] + bg * (1 - pred[..., np.newaxis])
+            latencies = []
+            for s in sizes:
+                x = torch.rand(1, 3, s, s, device=self.device)
+                model = self.get_model((s, s))
+                times = []
+                with torch.no_grad(), self.autocast():
+                    for _ in range(repeat + 1):
+                        sync()
+                        start = time.perf_counter()
+                        model(x)
+                        sync()
+                        times.append((time.perf_counter() - start) * 1000)
+                # the first run includes warm up
+                latencies.append(min(times[1:]))
 
-        elif type == "blur":
-            img = img * pred[..., np.newaxis] + cv2.GaussianBlur(img, (0, 0), 15) * (
-                1 - pred[..., np.newaxis]
-            )
+            per_mp, fixed = np.polyfit([s * s / 1e6 for s in sizes], latencies, 1)
+            cache[key] = [max(float(fixed), 0.0), max(float(per_mp), 1e-3)]
+            try:
+                tmp_path = "{}.{}.tmp".format(path, os.getpid())
+                with open(tmp_path, "w") as f:
+                    json.dump(cache, f)
+                os.replace(tmp_path, path)
+            except OSError:
+                pass
 
-        elif type == "overlay":
-            bg = (
-                np.stack([np.ones_like(pred)] * 3, axis=-1) * [120, 255, 155] + img
-            ) // 2
-            img = bg * pred[..., np.newaxis] + img * (1 - pred[..., np.newaxis])
-            border = cv2.Canny(((pred > 0.5) * 255).astype(np.uint8), 50, 100)
-            img[border != 0] = [120, 255, 155]
-
-        elif type.lower().endswith((".jpg", ".jpeg", ".png")):
-            if self.background['name'] != type:
-                background_img = cv2.cvtColor(cv2.imread(type), cv2.COLOR_BGR2RGB)
-                background_img = cv2.resize(background_img, img.shape[:2][::-1])
-                
-                self.background['img'] = background_img
-                self.background['shape'] = img.shape[:2][::-1]
-                self.background['name'] = type
-            
-            elif self.background['shape'] != img.shape[:2][::-1]:
-                self.background['img'] = cv2.resize(self.background['img'], img.shape[:2][::-1])
-                self.background['shape'] = img.shape[:2][::-1]
-
-            img = img * pred[..., np.newaxis] + self.background['img'] * (
-                1 - pred[..., np.newaxis]
-            )
+        self.cost_model = tuple(cache[key])
+        print("Settings -> Cost model={:.1f}ms + {:.1f}ms/MP".format(*self.cost_model))
+        return self.cost_model
 
-        if is_numpy:
-            return img.astype(np.uint8)
+    def autocast(self):
+        # fp32 never enters autocast, torch.autocast raises for device types without autocast (mps before torch 2.5)
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(
+            device_type=torch.device(self.device).type,
+            dtype=self.autocast_dtype,
+            enabled=self.autocast_dtype is not None,
+        )
+
+    def get_model(self, size, batch=1):
+        """
+        Args:
+            size (tuple): height and width of the network input
+            batch (int): batch size of the input, compiled models recompile for each batch size
+        Returns:
+            callable: model for the given input size. bucketed traces and compiled models are created lazily on first use.
+        """
+        if self.jit not in ("bucketed", "compile"):
+            return self.model
+
+        if self.jit == "compile" and (size, batch) not in self.compiled:
+            if len(self.compiled) >= COMPILE_CACHE_SIZE:
+                warnings.warn("torch.compile cache is full ({} shapes), running {}x{} with batch size {} eagerly.".format(
+                    COMPILE_CACHE_SIZE, *size, batch))
+                return self.model
+            self.compiled.add((size, batch))
+
+        if size not in self.artifacts:
+            if self.jit == "compile":
+                self.artifacts[size] = torch.compile(self.model, dynamic=False)
+            else:
+                path = "{}_{}{}_{}x{}_torch{}.pt".format(
+                    os.path.splitext(self.ckpt)[0], str(self.device).replace(":", ""), self.variant,
+                    *size, torch.__version__.split("+")[0]
+                )
+                try:
+                    self.artifacts[size] = torch.jit.load(path, map_location=self.device)
+                except:
+                    with torch.no_grad():
+                        self.artifacts[size] = torch.jit.trace(
+                            self.model, torch.rand(1, 3, *size).to(self.device), strict=True
+                        )
+                    torch.jit.save(self.artifacts[size], path)
+
+        return self.artifacts[size]
+
+    def preprocess(self, x, size):
+        """
+        Args:
+            x (torch.Tensor): float tensor of shape [B, H, W, C] in range 0 ~ 1
+            size (tuple): height and width of the network input
+        Returns:
+            torch.Tensor: normalized tensor of shape [B, 3, *size] on the model device
+        """
+        x = x[..., :3].to(self.device).permute(0, 3, 1, 2).float()
+        if tuple(x.shape[-2:]) != tuple(size):
+            # antialias only matters for downscaling, which is where PIL bilinear resize differs
+            antialias = x.shape[-2] > size[0] or x.shape[-1] > size[1]
+            x = F.interpolate(x, size, mode="bilinear", align_corners=False, antialias=antialias)
+        x = (x - self.mean) / self.std
+        return x.contiguous(memory_format=torch.channels_last) if self.channels_last else x
+
+    def forward(self, imgs, batch_size=8, tile_size=None, tile_overlap=128, latency=None):
+        """
+        Args:
+            imgs (torch.Tensor or list): float tensor of shape [B, H, W, C] in range 0 ~ 1, or list of [H, W, C] tensors with different sizes
+            batch_size (int): maximum number of images for a single forward pass
+            tile_size (int, optional): run tiled inference at full resolution with tiles of this size (multiple of 32, at least 384).
+                                       the whole image is forwarded once at base_size and blended with the tiles through the LR/HR pyramid.
+            tile_overlap (int): overlap between neighboring tiles, at most a quarter of tile_size
+            latency (float, optional): latency budget per image in milliseconds, the network input size is picked within it
+        Yields:
+            tuple: indices of the images and their soft predictions of shape [b, 1, H, W] on the model device
+        """
+        if tile_size and self.jit in (True, "bucketed"):
+            raise AttributeError("tiled inference is not available with TorchScript.")
+        if tile_size:
+            if tile_size < BUCKET_SIZES[0]:
+                raise ValueError("tile_size must be 0 (off) or at least {}, got {}.".format(BUCKET_SIZES[0], tile_size))
+            # the tile stride stays positive, so every pixel is covered by a tile
+            tile_overlap = min(tile_overlap, tile_size // 4)
+
+        buckets = {}
+        for i, img in enumerate(imgs):
+            buckets.setdefault(self.get_size(tuple(img.shape[:2]), tile_size, latency), []).append(i)
+
+        def batch(chunk, size):
+            if torch.is_tensor(imgs):
+                return self.preprocess(imgs[chunk], size)
+            else:
+                return torch.cat([self.preprocess(imgs[i].unsqueeze(0), size) for i in chunk])
+
+        for size, indices in buckets.items():
+            for j in range(0, len(indices), batch_size):
+                chunk = indices[j:j + batch_size]
+                x = batch(chunk, size)
+
+                with torch.no_grad(), self.autocast():
+                    if tile_size:
+                        pred = self.model.forward_tiled(x, batch(chunk, self.meta.base_size), tile_size, tile_overlap)
+                    elif self.jit in (True, "bucketed"):
+                        # traces bake the batch size of the example input, so they are run one image at a time
+                        model = self.get_model(size)
+                        pred = torch.cat([model(x[k:k + 1]) for k in range(len(x))])
+                    else:
+                        pred = self.get_model(size, len(x))(x)
+
+                if torch.is_tensor(imgs):
+                    yield chunk, F.interpolate(pred, tuple(imgs.shape[1:3]), mode="bilinear", align_corners=True)
+                else:
+                    for i, p in zip(chunk, pred):
+                        yield [i], F.interpolate(p.unsqueeze(0), tuple(imgs[i].shape[:2]), mode="bilinear", align_corners=True)
+
+    def predict(self, imgs, batch_size=8, tile_size=None, tile_overlap=128, latency=None):
+        """
+        Args:
+            imgs (torch.Tensor or list): float tensor of shape [B, H, W, C] in range 0 ~ 1, or list of [H, W, C] tensors with different sizes
+            batch_size (int): maximum number of images for a single forward pass
+            tile_size, tile_overlap, latency: see `forward`
+        Returns:
+            torch.Tensor or list: soft prediction of shape [B, H, W] (or list of [H, W]) on the device of the input, in the input order
+        """
+        if torch.is_tensor(imgs):
+            preds = torch.empty(imgs.shape[:3], dtype=torch.float32, device=imgs.device)
+        else:
+            preds = [None] * len(imgs)
+
+        for chunk, pred in self.forward(imgs, batch_size=batch_size, tile_size=tile_size, tile_overlap=tile_overlap, latency=latency):
+            for i, p in zip(chunk, pred):
+                preds[i] = p[0].to(imgs[i].device)
+
+        return preds
+
+    def process_batch(self, imgs, type="rgba", threshold=None, batch_size=8, tile_size=None, tile_overlap=128, latency=None):
+        """
+        Args:
+            imgs (torch.Tensor or list): float tensor of shape [B, H, W, C] in range 0 ~ 1, or list of [H, W, C] tensors with different sizes.
+                                         images are grouped by their network input size and each group is forwarded in batches.
+            type (str or list, optional): output type option. see `process`. a list of three integers is used as a background color.
+                                          no composition is done if None, which is useful when only the alpha matte is needed.
+            threshold (float or str, optional): see `process`
+            batch_size (int): maximum number of images for a single forward pass
+            tile_size, tile_overlap, latency: see `forward`
+        Returns:
+            tuple: output images of shape [B, H, W, C] (None if type is None) and alpha mattes of shape [B, H, W],
+                   as float tensors in range 0 ~ 1 on the device of the input (lists of tensors for list input)
+        """
+        if isinstance(type, str) and type.startswith("["):
+            type = [int(i) for i in type[1:-1].split(",")]
+
+        if isinstance(type, (list, tuple)) and len(type) > 0 and isinstance(type[0], (list, tuple)):
+            # per frame colours, indexed along with their images below
+            type = torch.tensor(type, dtype=torch.float32)
+
+        channels = 4 if isinstance(type, str) and type == "rgba" else 3
+        if torch.is_tensor(imgs):
+            masks = torch.empty(imgs.shape[:3], dtype=torch.float32, device=imgs.device)
+            outs = None if type is None else torch.empty((*imgs.shape[:3], channels), dtype=torch.float32, device=imgs.device)
         else:
-            return Image.fromarray(img.astype(np.uint8))
+            masks = [None] * len(imgs)
+            outs = None if type is None else [None] * len(imgs)
+
+        for chunk, pred in self.forward(imgs, batch_size=batch_size, tile_size=tile_size, tile_overlap=tile_overlap, latency=latency):
+            if threshold is not None:
+                pred = self.refine(pred, threshold)
+            alpha = pred[:, 0]
+
+            if type is not None:
+                # chunks are arbitrary images of a size bucket, per image backgrounds and colours are picked by index
+                bg = type[chunk] if torch.is_tensor(type) and len(type) == len(imgs) else type
+                if torch.is_tensor(imgs):
+                    out = self.composite(imgs[chunk], alpha, bg)
+                else:
+                    out = self.composite(imgs[chunk[0]].unsqueeze(0), alpha, bg)
+
+            for k, i in enumerate(chunk):
+                masks[i] = alpha[k].to(imgs[i].device)
+                if type is not None:
+                    outs[i] = out[k].to(imgs[i].device)
+
+        return outs, masks
+
+    def select_keyframes(self, imgs, keyframe_interval=30, change_threshold=0.02, size=64):
+        """
+        Args:
+            imgs (torch.Tensor): consecutive frames of shape [B, H, W, C] in range 0 ~ 1
+            keyframe_interval (int): a frame is always inferred after this many frames without inference
+            change_threshold (float): a frame is inferred if its mean absolute difference to the last inferred frame exceeds this value.
+                                      measured on frames downscaled to `size` on the short side.
+        Returns:
+            tuple: indices of frames to be inferred, and for every frame the index of the inferred frame whose matte it reuses
+        """
+        scale = size / min(imgs.shape[1:3])
+        thumb_size = (max(int(imgs.shape[1] * scale), 1), max(int(imgs.shape[2] * scale), 1))
+
+        thumbs = []
+        for i in range(0, len(imgs), 64):
+            x = imgs[i:i + 64, ..., :3].to(self.device).permute(0, 3, 1, 2).float()
+            thumbs.append(F.interpolate(x, thumb_size, mode="area"))
+        thumbs = torch.cat(thumbs)
+
+        # difference to the last inferred frame rather than the previous frame, so slow drift still triggers inference
+        keys, sources = [], []
+        for i in range(len(thumbs)):
+            if len(keys) == 0 or i - keys[-1] >= keyframe_interval or \
+                    (thumbs[i] - thumbs[keys[-1]]).abs().mean().item() > change_threshold:
+                keys.append(i)
+            sources.append(keys[-1])
+
+        return keys, sources
+
+    def process_frames(self, imgs, type="rgba", threshold=None, batch_size=8, tile_size=None, tile_overlap=128,
+                       keyframe_interval=30, change_threshold=0.02, smoothing=0.0, latency=None):
+        """
+        Temporal version of `process_batch` for frames of a video clip. only keyframes and frames that changed enough are inferred,
+        the other frames reuse the matte of the last inferred frame.
+
+        Args:
+            imgs (torch.Tensor): consecutive frames of shape [B, H, W, C] in range 0 ~ 1
+            type, threshold, batch_size, tile_size, tile_overlap, latency: see `process_batch`
+            keyframe_interval, change_threshold: see `select_keyframes`
+            smoothing (float): exponential moving average weight of the previous matte (0.0 ~ 1.0). 0 disables smoothing.
+        Returns:
+            tuple: output images and alpha mattes as `process_batch`, and the indices of the inferred frames
+        """
+        if isinstance(type, str) and type.startswith("["):
+            type = [int(i) for i in type[1:-1].split(",")]
+
+        keys, sources = self.select_keyframes(imgs, keyframe_interval, change_threshold)
+        preds = self.predict(imgs[keys], batch_size=batch_size, tile_size=tile_size, tile_overlap=tile_overlap, latency=latency)
+        preds = preds[[keys.index(i) for i in sources]]
+
+        if smoothing > 0:
+            for i in range(1, len(preds)):
+                preds[i] = smoothing * preds[i - 1] + (1 - smoothing) * preds[i]
+
+        outs, masks = self.process_preds(imgs, preds, type=type, threshold=threshold, batch_size=batch_size)
+        return outs, masks, keys
+
+    def process_preds(self, imgs, preds, type="rgba", threshold=None, batch_size=8):
+        """
+        Refine and composition of `process_batch` for soft predictions computed elsewhere, e.g. by `predict` or a cache.
+
+        Args:
+            imgs (torch.Tensor or list): images as `process_batch`, or uint8 images for fixed point composition with uint8 outputs
+            preds (torch.Tensor or list): soft predictions of shape [B, H, W] (or list of [H, W]) matching imgs
+            type, threshold, batch_size: see `process_batch`
+        Returns:
+            tuple: output images and alpha mattes as `process_batch`
+        """
+        if isinstance(type, str) and type.startswith("["):
+            type = [int(i) for i in type[1:-1].split(",")]
+
+        if isinstance(type, (list, tuple)) and len(type) > 0 and isinstance(type[0], (list, tuple)):
+            # per frame colours, sliced along with their images below
+            type = torch.tensor(type, dtype=torch.float32)
+
+        channels = 4 if isinstance(type, str) and type == "rgba" else 3
+        dtype = torch.uint8 if imgs[0].dtype == torch.uint8 else torch.float32
+        if not torch.is_tensor(imgs):
+            outs, masks = [], []
+            for k, (img, pred) in enumerate(zip(imgs, preds)):
+                bg = type[k:k + 1] if torch.is_tensor(type) and len(type) == len(imgs) else type
+                out, mask = self.process_preds(img[None], pred[None], type=bg, threshold=threshold)
+                outs.append(None if out is None else out[0])
+                masks.append(mask[0])
+            return None if type is None else outs, masks
+
+        masks = torch.empty(imgs.shape[:3], dtype=torch.float32, device=imgs.device)
+        outs = None if type is None else torch.empty((*imgs.shape[:3], channels), dtype=dtype, device=imgs.device)
+
+        for i in range(0, len(imgs), batch_size):
+            pred = preds[i:i + batch_size].to(self.device)[:, None]
+            if threshold is not None:
+                pred = self.refine(pred, threshold)
+            alpha = pred[:, 0]
+
+            masks[i:i + batch_size] = alpha.to(imgs.device)
+            if type is not None:
+                # per image backgrounds and colours follow the chunk of their images
+                bg = type[i:i + batch_size] if torch.is_tensor(type) and len(type) == len(imgs) else type
+                outs[i:i + batch_size] = self.composite(imgs[i:i + batch_size], alpha, bg).to(imgs.device)
+
+        return outs, masks
+
+    def composite(self, img, alpha, type="rgba"):
+        """
+        Args:
+            img (torch.Tensor): tensor of shape [B, H, W, C], float in range 0 ~ 1 or uint8
+            alpha (torch.Tensor): alpha matte of shape [B, H, W]
+            type (str, list or torch.Tensor): output type option. see `process` and `Compositor`. a tensor of shape [B, H, W, C]
+                                              (or [1, H, W, C] for all images) is used as background images, resized to the input.
+        Returns:
+            torch.Tensor: output image of shape [B, H, W, C] in the dtype of img on the device of the alpha matte
+        """
+        return self.compositor(img, alpha, type)
+
+    def refine(self, pred, threshold):
+        """
+        Args:
+            pred (torch.Tensor or np.ndarray): soft prediction of shape [B, 1, H, W], or [H, W] for a single image
+            threshold (float or str): threshold value (0.0 ~ 1.0)
+        Returns:
+            torch.Tensor or np.ndarray: prediction with hard edges w.r.t the threshold, blended with the soft prediction around the edges.
+                                        the whole batch is refined at once on the model device.
+        """
+        if isinstance(pred, np.ndarray):
+            x = torch.from_numpy(pred).float().to(self.device)[None, None]
+            return refine(x, threshold)[0, 0].cpu().numpy()
+
+        return refine(pred.float(), threshold)
+
+    def postprocess(self, img, pred, type="rgba", threshold=None):
+        """
+        Args:
+            img (np.ndarray): input image of shape [H, W, 3]
+            pred (np.ndarray): soft prediction of shape [H, W]
+            type (str): output type option. see `process`
+            threshold (float or str, optional): see `process`
+        Returns:
+            np.ndarray: output image
+        """
+        x = torch.from_numpy(np.ascontiguousarray(img, dtype=np.uint8)).unsqueeze(0)
+        pred = torch.from_numpy(np.asarray(pred, dtype=np.float32)).unsqueeze(0)
+        img, _ = self.process_preds(x, pred, type=type, threshold=threshold)
+        return img[0].numpy()
 
 def to_base64(image):
     buffered = BytesIO()
@@ -303,7 +658,215 @@ def to_base64(image):
     base64_img = base64.b64encode(buffered.getvalue()).decode("utf-8")
     return base64_img
 
-def entry_point(out_type, mode, device, ckpt, source, dest, jit, threshold, flet_progress=None, flet_page=None, preview=None, preview_out=None, options=None):
+def get_outname(name, out_type):
+    if out_type.lower().endswith((".jpg", ".jpeg", ".png")):
+        return "{}_{}".format(
+            os.path.splitext(name)[0],
+            os.path.splitext(os.path.split(out_type)[-1])[0],
+        )
+    else:
+        return "{}_{}".format(os.path.splitext(name)[0], out_type)
+
+def process_images(remover, images, save_dir, type="rgba", threshold=None, batch_size=8, workers=None, shard=None, progress=None, callback=None):
+    """
+    Parallel and resumable image matting. a pool of worker threads reads, hashes and decodes inputs ahead of a single inference
+    stage and encodes outputs behind it. finished outputs are recorded in a manifest in save_dir with the content hash of their
+    input and the settings, so files already processed the same way are skipped on the next run.
+
+    Args:
+        remover (Remover): model to run
+        images (list): paths of the input images
+        save_dir (str): directory of the outputs and the manifest
+        type, threshold: see `Remover.process`
+        batch_size (int): maximum number of images for a single forward pass
+        workers (int, optional): number of decode and encode threads. number of cpus up to 8 if not specified.
+        shard (tuple, optional): index and count of the shard of this process, see `Manifest`. images should be filtered already.
+        progress (tqdm.tqdm, optional): progress bar updated per image
+        callback (callable, optional): called with the input and output of the last image of each batch as PIL images.
+                                       stops early if it returns True.
+    Returns:
+        dict: number of processed and skipped images
+    """
+    workers = workers or min(8, os.cpu_count() or 1)
+    prefetch = max(batch_size, workers) * 2
+    manifest = Manifest(save_dir, shard)
+    settings = {"type": str(type), "threshold": threshold, "mode": remover.mode, "ckpt": os.path.split(remover.ckpt)[-1]}
+    stats = {"processed": 0, "skipped": 0}
+
+    def decode(path):
+        name = os.path.split(path)[-1]
+        with open(path, "rb") as f:
+            data = f.read()
+        entry = dict(settings, md5=hashlib.md5(data).hexdigest())
+        if manifest.done(name, entry) and os.path.isfile(os.path.join(save_dir, "{}.png".format(get_outname(name, type)))):
+            return name, entry, None
+        return name, entry, np.array(Image.open(BytesIO(data)).convert("RGB"))
+
+    def encode(name, entry, out):
+        Image.fromarray(out).save(os.path.join(save_dir, "{}.png".format(get_outname(name, type))))
+        manifest.update(name, entry)
+
+    with ThreadPoolExecutor(workers) as pool:
+        paths = iter(images)
+        decoding = deque(pool.submit(decode, path) for path in itertools.islice(paths, prefetch))
+        encoding = deque()
+        batch = []
+        stop = False
+
+        while (len(decoding) > 0 or len(batch) > 0) and not stop:
+            if len(decoding) > 0:
+                name, entry, img = decoding.popleft().result()
+                decoding.extend(pool.submit(decode, path) for path in itertools.islice(paths, 1))
+                if img is None:
+                    stats["skipped"] += 1
+                    if progress is not None:
+                        progress.update()
+                    continue
+                batch.append((name, entry, img))
+
+            if len(batch) < batch_size and len(decoding) > 0:
+                continue
+
+            # uint8 images are composited in fixed point, only the network input is converted to float
+            x = [torch.from_numpy(img).to(remover.device) for _, _, img in batch]
+            preds = remover.predict([i.float() / 255 for i in x], batch_size=batch_size)
+            outs, _ = remover.process_preds(x, preds, type=type, threshold=threshold, batch_size=batch_size)
+            for (name, entry, _), out in zip(batch, outs):
+                out = out.cpu().numpy()
+                encoding.append(pool.submit(encode, name, entry, out))
+
+            # bounded number of outputs waiting to be encoded
+            while len(encoding) > prefetch:
+                encoding.popleft().result()
+
+            stats["processed"] += len(batch)
+            if progress is not None:
+                progress.update(len(batch))
+            if callback is not None and callback(Image.fromarray(batch[-1][2]), Image.fromarray(out)) is True:
+                stop = True
+            batch = []
+
+        for future in decoding:
+            future.cancel()
+        for future in encoding:
+            future.result()
+
+    manifest.flush()
+    return stats
+
+def process_video(remover, source, dest, type="rgba", threshold=None, batch_size=8, prefetch=32, progress=None, callback=None):
+    """
+    Pipelined video matting. frames are decoded by a background thread into a bounded prefetch queue, consecutive frames are
+    forwarded in batches, and the outputs are encoded by another background thread, so decode and encode overlap with inference.
+
+    Args:
+        remover (Remover): model to run
+        source (str): path of the input video
+        dest (str): path of the output video
+        type, threshold: see `Remover.process`
+        batch_size (int): number of consecutive frames for a single forward pass
+        prefetch (int): maximum number of decoded frames waiting for inference
+        progress (tqdm.tqdm, optional): progress bar updated per frame, with frames per second of each stage as postfix
+        callback (callable, optional): called with input and output frames of each batch as uint8 RGB arrays. stops early if it returns True.
+    Returns:
+        dict: frames per second of decode, inference and encode stages, w.r.t the time each stage was busy
+    """
+    cap = cv2.VideoCapture(source)
+    size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    writer = cv2.VideoWriter(dest, cv2.VideoWriter_fourcc(*"mp4v"), cap.get(cv2.CAP_PROP_FPS), size)
+
+    frames = queue.Queue(maxsize=prefetch)
+    outputs = queue.Queue(maxsize=max(prefetch // batch_size, 2))
+    busy = {"decode": 0.0, "infer": 0.0, "encode": 0.0}
+    count = dict.fromkeys(busy, 0)
+    errors = []
+    stop = False
+
+    def stats():
+        return {stage: round(count[stage] / busy[stage], 1) if busy[stage] > 0 else 0.0 for stage in busy}
+
+    def decode():
+        try:
+            while not stop:
+                start = time.perf_counter()
+                ret, frame = cap.read()
+                if ret is False:
+                    break
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                busy["decode"] += time.perf_counter() - start
+                count["decode"] += 1
+                frames.put(frame)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            frames.put(None)
+
+    def encode():
+        # keeps consuming after an error, so inference never blocks on a full queue
+        while True:
+            outs = outputs.get()
+            if outs is None:
+                break
+            if len(errors) > 0:
+                continue
+            try:
+                start = time.perf_counter()
+                for out in outs:
+                    writer.write(cv2.cvtColor(out, cv2.COLOR_RGB2BGR))
+                busy["encode"] += time.perf_counter() - start
+                count["encode"] += len(outs)
+            except Exception as e:
+                errors.append(e)
+
+    decoder = Thread(target=decode, daemon=True)
+    encoder = Thread(target=encode, daemon=True)
+    decoder.start()
+    encoder.start()
+
+    done = False
+    try:
+        while not done and len(errors) == 0:
+            batch = []
+            while len(batch) < batch_size:
+                frame = frames.get()
+                if frame is None:
+                    done = True
+                    break
+                batch.append(frame)
+            if len(batch) == 0:
+                break
+
+            start = time.perf_counter()
+            x = torch.from_numpy(np.stack(batch)).to(remover.device)
+            preds = remover.predict(x.float() / 255, batch_size=batch_size)
+            outs, _ = remover.process_preds(x, preds, type=type, threshold=threshold, batch_size=batch_size)
+            outs = outs.cpu().numpy()
+            busy["infer"] += time.perf_counter() - start
+            count["infer"] += len(batch)
+
+            outputs.put(outs)
+            if progress is not None:
+                progress.update(len(batch))
+                progress.set_postfix({"{}_fps".format(stage): fps for stage, fps in stats().items()})
+            if callback is not None and callback(batch, outs) is True:
+                break
+    finally:
+        # unblock the decoder if inference stopped early or failed, then release both ends
+        stop = True
+        while not done:
+            done = frames.get() is None
+
+        outputs.put(None)
+        encoder.join()
+        decoder.join()
+        cap.release()
+        writer.release()
+
+    if len(errors) > 0:
+        raise errors[0]
+    return stats()
+
+def entry_point(out_type, mode, device, ckpt, source, dest, jit, threshold, flet_progress=None, flet_page=None, preview=None, preview_out=None, options=None, batch_size=8, workers=None, shard=None, latency=None):
     warnings.filterwarnings("ignore")
 
     remover = Remover(mode=mode, jit=jit, device=device, ckpt=ckpt)
@@ -341,6 +904,11 @@ def entry_point(out_type, mode, device, ckpt, source, dest, jit, threshold, flet
         os.makedirs(save_dir, exist_ok=True)
 
     loader = eval(_format + "Loader")(source)
+    if _format == "Image" and shard is not None:
+        shard = parse_shard(shard) if isinstance(shard, str) else shard
+        loader.images = [i for i in loader.images if in_shard(os.path.split(i)[-1], shard)]
+        loader.size = len(loader.images)
+
     frame_progress = tqdm.tqdm(
         total=len(loader),
         position=1 if (_format == "Video" and len(loader) > 1) else 0,
@@ -362,50 +930,88 @@ def entry_point(out_type, mode, device, ckpt, source, dest, jit, threshold, flet
         flet_progress.value = 0
         flet_step = 1 / frame_progress.total
 
-    writer = None
+    def show(img, out):
+        if out_type == 'rgba':
+            o = np.array(out).astype(np.float64)
+            o[:, :, :3] *= (o[:, :, -1:] / 255)
+            out = Image.fromarray(o[:, :, :3].astype(np.uint8))
 
-    for img, name in loader:
-        frame_progress.set_description("{}".format(name))
-        if out_type.lower().endswith((".jpg", ".jpeg", ".png")):
-            outname = "{}_{}".format(
-                os.path.splitext(name)[0],
-                os.path.splitext(os.path.split(out_type)[-1])[0],
-            )
-        else:
-            outname = "{}_{}".format(os.path.splitext(name)[0], out_type)
-
-        if _format == "Video" and writer is None:
-            writer = cv2.VideoWriter(
-                os.path.join(save_dir, "{}.mp4".format(outname)),
-                cv2.VideoWriter_fourcc(*"mp4v"),
-                loader.fps,
-                img.size,
-            )
+        preview.src_base64 = to_base64(img.resize((480, 300)).convert('RGB'))
+        preview_out.src_base64 = to_base64(out.resize((480, 300)).convert('RGB'))
+        preview.update()
+        preview_out.update()
+
+    if _format == "Video":
+        def callback(frames, outs):
+            if flet_progress is not None:
+                flet_progress.value += flet_step * len(frames)
+                flet_progress.update()
+                show(Image.fromarray(frames[-1]), Image.fromarray(outs[-1]))
+            return options is not None and options['abort']
+
+        for video in loader.videos:
+            name = os.path.split(video)[-1]
+            frame_progress.set_description("{}".format(name))
             frame_progress.refresh()
             frame_progress.reset()
-            frame_progress.total = int(loader.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap = cv2.VideoCapture(video)
+            frame_progress.total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap.release()
             if sample_progress is not None:
                 sample_progress.update()
 
             if flet_progress is not None:
-                assert flet_page is not None
                 flet_progress.value = 0
-                flet_step = 1 / frame_progress.total
+                flet_step = 1 / max(frame_progress.total, 1)
                 flet_progress.update()
 
-        if _format == "Video" and img is None:
-            if writer is not None:
-                writer.release()
-            writer = None
-            continue
+            process_video(
+                remover,
+                video,
+                os.path.join(save_dir, "{}.mp4".format(get_outname(name, out_type))),
+                type=out_type,
+                threshold=threshold,
+                batch_size=batch_size,
+                progress=frame_progress,
+                callback=callback,
+            )
+            if options is not None and options['abort']:
+                break
+
+        print("\nDone. Results are saved in {}".format(os.path.abspath(save_dir)))
+        return
 
+    if _format == "Image":
+        def callback(img, out):
+            if flet_progress is not None:
+                flet_progress.value = frame_progress.n * flet_step
+                flet_progress.update()
+                show(img, out)
+            return options is not None and options['abort']
+
+        frame_progress.set_description("{}".format(os.path.split(source)[-1]))
+        stats = process_images(
+            remover,
+            loader.images,
+            save_dir,
+            type=out_type,
+            threshold=threshold,
+            batch_size=batch_size,
+            workers=workers,
+            shard=shard,
+            progress=frame_progress,
+            callback=callback,
+        )
+        print("\nDone. {} processed, {} unchanged. Results are saved in {}".format(stats["processed"], stats["skipped"], os.path.abspath(save_dir)))
+        return
+
+    # without a latency budget the controller never switches, it only collects latency stats
+    controller = LatencyController(latency if latency is not None else float("inf"))
+
+    for img, name in loader:
         out = remover.process(img, type=out_type, threshold=threshold)
 
-        if _format == "Image":
-            out.save(os.path.join(save_dir, "{}.png".format(outname)))
-        elif _format == "Video" and writer is not None:
-            writer.write(cv2.cvtColor(np.array(out), cv2.COLOR_BGR2RGB))
-        elif _format == "Webcam":
+        if _format == "Webcam":
             if vcam is not None:
                 vcam.send(np.array(out))
                 vcam.sleep_until_next_frame()
@@ -413,26 +1019,24 @@ def entry_point(out_type, mode, device, ckpt, source, dest, jit, threshold, flet
                 cv2.imshow(
                     "transparent-background", cv2.cvtColor(np.array(out), cv2.COLOR_BGR2RGB)
                 )
+
+            elapsed = (time.perf_counter() - loader.timestamp) * 1000
+            sizing = controller.update(elapsed)
+            if latency is not None:
+                remover.sizing = sizing
+            frame_progress.set_postfix(latency_ms=round(elapsed, 1), dropped=loader.dropped, sizing=remover.sizing or mode)
+
         frame_progress.update()
         if flet_progress is not None:
             flet_progress.value += flet_step
             flet_progress.update()
-
-            if out_type == 'rgba':
-                o = np.array(out).astype(np.float64)
-                o[:, :, :3] *= (o[:, :, -1:] / 255)
-                out = Image.fromarray(o[:, :, :3].astype(np.uint8))
-
-            preview.src_base64 = to_base64(img.resize((480, 300)).convert('RGB'))
-            preview_out.src_base64 = to_base64(out.resize((480, 300)).convert('RGB'))
-            preview.update()
-            preview_out.update()
+            show(img, out)
 
         if options is not None and options['abort']:
             break
-        
-    print("\nDone. Results are saved in {}".format(os.path.abspath(save_dir)))
+
+    print("\nDone. Webcam -> {}".format(dict(controller.stats(), dropped=loader.dropped)))
 
 def console():
     args = parse_args()
-    entry_point(args.type, args.mode, args.device, args.ckpt, args.source, args.dest, args.jit, args.threshold)
+    entry_point(args.type, args.mode, args.device, args.ckpt, args.source, args.dest, args.jit, args.threshold, batch_size=args.batch_size, workers=args.workers, shard=args.shard, latency=args.latency)
@@ -1 +1,4 @@
 from .Remover import Remover, console
+from .registry import ModelRegistry, registry
+from .cache import MatteCache, matte_cache
+from .pool import RemoverPool
@@ -10,8 +10,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 import numpy as np
+from collections import OrderedDict
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
+from ..modules.layers import attention
+
 class Mlp(nn.Module):
     """ Multilayer perceptron."""
 
@@ -65,6 +68,65 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+def compute_attn_mask(Hp, Wp, window_size, shift_size, device=None, dtype=torch.float32):
+    """
+    Args:
+        Hp, Wp (int): padded spatial resolution, multiples of window_size
+        window_size (int): Window size
+        shift_size (int): Shift size for SW-MSA
+
+    Returns:
+        attn_mask: (0/-100) mask with shape of (num_windows, Wh*Ww, Wh*Ww)
+    """
+    img_mask = torch.zeros((1, Hp, Wp, 1), device=device, dtype=dtype)  # 1 Hp Wp 1
+    h_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    w_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    return attn_mask
+
+
+class AttnMaskCache:
+    """ Bounded LRU cache of shifted window attention masks.
+
+    Masks only depend on the padded resolution, so repeated inference at the same resolution skips rebuilding them.
+
+    Args:
+        maxsize (int): Maximum number of cached masks. Default: 32
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.masks = OrderedDict()
+
+    def get(self, Hp, Wp, window_size, shift_size, device, dtype):
+        key = (Hp, Wp, window_size, shift_size, str(device), dtype)
+        if key in self.masks:
+            self.masks.move_to_end(key)
+            return self.masks[key]
+
+        attn_mask = compute_attn_mask(Hp, Wp, window_size, shift_size, device=device, dtype=dtype)
+        self.masks[key] = attn_mask
+        if len(self.masks) > self.maxsize:
+            self.masks.popitem(last=False)
+        return attn_mask
+
+    def clear(self):
+        self.masks.clear()
+
+
 class WindowAttention(nn.Module):
     """ Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -111,7 +173,6 @@ class WindowAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
-        self.softmax = nn.Softmax(dim=-1)
 
     def forward(self, x, mask=None):
         """ Forward function.
@@ -124,25 +185,20 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
         relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
             self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
+        attn_mask = relative_position_bias.permute(2, 0, 1).unsqueeze(0)  # 1, nH, Wh*Ww, Wh*Ww
 
         if mask is not None:
+            # windows are folded into the head dimension, so the bias and shift mask of every window
+            # broadcast over the batch instead of being repeated for each image
             nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
+            attn_mask = (attn_mask + mask.unsqueeze(1)).reshape(1, nW * self.num_heads, N, N)
+            q, k, v = [t.reshape(B_ // nW, nW * self.num_heads, N, -1) for t in (q, k, v)]
 
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        # attention dropout is only used for training, where this backbone is not
+        x = attention(q, k, v, attn_mask=attn_mask, scale=self.scale)
+        x = x.reshape(B_, self.num_heads, N, -1).transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -331,6 +387,7 @@ class BasicLayer(nn.Module):
         self.shift_size = window_size // 2
         self.depth = depth
         self.use_checkpoint = use_checkpoint
+        self.mask_cache = None
 
         # build blocks
         self.blocks = nn.ModuleList([
@@ -365,23 +422,10 @@ class BasicLayer(nn.Module):
         # calculate attention mask for SW-MSA
         Hp = int(np.ceil(H / self.window_size)) * self.window_size
         Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
-        h_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        w_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+        if self.mask_cache is not None:
+            attn_mask = self.mask_cache.get(Hp, Wp, self.window_size, self.shift_size, x.device, x.dtype)
+        else:
+            attn_mask = compute_attn_mask(Hp, Wp, self.window_size, self.shift_size, device=x.device, dtype=x.dtype)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
@@ -537,6 +581,11 @@ class SwinTransformer(nn.Module):
                 use_checkpoint=use_checkpoint)
             self.layers.append(layer)
 
+        # attention masks shared by every stage, rebuilt only when the input resolution changes
+        self.attn_mask_cache = AttnMaskCache()
+        for layer in self.layers:
+            layer.mask_cache = self.attn_mask_cache
+
         num_features = [int(embed_dim * 2 ** i) for i in range(self.num_layers)]
         self.num_features = num_features
 
@@ -0,0 +1,653 @@
+"""
+Benchmarks for InSPyReNet with random weights, so no checkpoint download and no network is needed.
+
+    python -m py.inspyrenet.benchmark suite --output results.json
+    python -m py.inspyrenet.benchmark suite --compare results.json
+    python -m py.inspyrenet.benchmark forward --mode fast --size 384x384 --batch 1,4,8
+    python -m py.inspyrenet.benchmark preprocess --size 1080x1920 --batch 1,8
+    python -m py.inspyrenet.benchmark refine --size 1024x1024,2160x3840 --check
+    python -m py.inspyrenet.benchmark pyramid --size 512x512,1024x1024 --check
+    python -m py.inspyrenet.benchmark attention --size 1280x1280 --check
+    python -m py.inspyrenet.benchmark fuse --mode base --batch 1,4 --check
+
+    python -m py.inspyrenet.benchmark tiled --size 4096x6144 --tile 1024
+    python -m py.inspyrenet.benchmark swin_mask --size 1024x1024,1280x1920
+    python -m py.inspyrenet.benchmark precision --mode base --ckpt ~/.transparent-background/ckpt_base.pth --images samples/
+    python -m py.inspyrenet.benchmark int8
+    python -m py.inspyrenet.benchmark import
+    python -m py.inspyrenet.benchmark load --mode base
+    python -m py.inspyrenet.benchmark pool --workers 8 --count 32
+
+Cases reporting peak memory run in a fresh process so that the peak RSS of one case does not leak into another.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import subprocess
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import torch
+
+import numpy as np
+import torch.nn.functional as F
+
+from .InSPyReNet import InSPyReNet_SwinB
+from .backbones.SwinTransformer import AttnMaskCache, WindowAttention, compute_attn_mask
+from .modules.layers import ImagePyramid, SelfAttention, Transition, fuse_conv_bn
+from .utils import ImageLoader, get_autocast_dtype, get_dynamic_size, load_weights
+
+BASE_SIZES = {'base': [1024, 1024], 'fast': [384, 384]}
+
+def build_model(mode='base', device='cpu', ckpt=None):
+    """
+    Args:
+        ckpt (str, optional): load real weights from this checkpoint instead of random ones
+    """
+    torch.manual_seed(0)
+    model = InSPyReNet_SwinB(depth=64, pretrained=False, base_size=BASE_SIZES[mode], threshold=None)
+    if ckpt is not None:
+        model.load_state_dict(torch.load(ckpt, map_location='cpu'), strict=True)
+    return model.eval().to(device)
+
+def load_images(size, root=None, count=8):
+    """
+    Args:
+        size (list): height and width of the network input
+        root (str, optional): directory of images. a fixed, seeded set of smooth random images is used if not specified.
+    Returns:
+        torch.Tensor: normalized images of shape [N, 3, *size]
+    """
+    if root is not None:
+        imgs = [torch.from_numpy(np.array(img)).float().div(255).permute(2, 0, 1) for img, _ in ImageLoader(root)]
+        imgs = torch.stack([F.interpolate(img[None], size, mode='bilinear', align_corners=False)[0] for img in imgs[:count]])
+    else:
+        generator = torch.Generator().manual_seed(0)
+        imgs = torch.rand(count, 3, size[0] // 32, size[1] // 32, generator=generator)
+        imgs = F.interpolate(imgs, size, mode='bicubic', align_corners=False).clamp(0, 1)
+
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    return (imgs - mean) / std
+
+def synchronize(device):
+    if 'cuda' in str(device):
+        torch.cuda.synchronize()
+
+def timeit(fn, repeat=3, warmup=1, device='cpu'):
+    """
+    Returns:
+        float: median latency of fn in milliseconds
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        synchronize(device)
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            synchronize(device)
+            times.append((time.perf_counter() - start) * 1000)
+
+    return sorted(times)[len(times) // 2]
+
+def peak_memory(device='cpu'):
+    """
+    Returns:
+        float: peak allocated memory in MB, process peak RSS for cpu
+    """
+    if 'cuda' in str(device):
+        return torch.cuda.max_memory_allocated() / 1024 ** 2
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+def isolated(fn, **kwargs):
+    """
+    Runs fn in a fresh process. if the process dies, e.g. killed for running out of memory, an error result is returned
+    instead of waiting for it forever.
+    """
+    with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+        try:
+            return pool.submit(fn, **kwargs).result()
+        except BrokenProcessPool:
+            result = {'case': fn.__name__[len('run_'):]}
+            result.update({k: list(v) if isinstance(v, tuple) else v for k, v in kwargs.items()
+                           if isinstance(v, (int, float, str, list, tuple)) and k not in ('repeat', 'root', 'ckpt')})
+            result['error'] = 'benchmark process died, likely killed for running out of memory'
+            return result
+
+def parse_size(size):
+    return [int(i) for i in size.lower().split('x')]
+
+def parse_list(value, default, parse=int):
+    return [parse(i) for i in (value or default).split(',')]
+
+def build_remover(mode='base', device='cpu', root=None):
+    """
+    Args:
+        root (str): directory for the random weight checkpoint and the transparent-background config, kept out of the home directory
+    Returns:
+        Remover: model with random weights
+    """
+    from .Remover import Remover
+
+    ckpt = os.path.join(root, 'ckpt_{}.pth'.format(mode))
+    if not os.path.isfile(ckpt):
+        torch.save(build_model(mode).state_dict(), ckpt)
+    os.environ['TRANSPARENT_BACKGROUND_FILE_PATH'] = root
+    return Remover(mode=mode, device=device, ckpt=ckpt)
+
+def run_tiled(size, tile_size=1024, overlap=128, strategy='tiled', mode='base', device='cpu', repeat=3):
+    """
+    Args:
+        size (list): height and width of the input
+        strategy (str): 'tiled' for `forward_tiled`, 'single' for one pass at full resolution,
+                        'dynamic' for one pass after the default dynamic resize (short side capped at 1280)
+    """
+    model = build_model(mode, device)
+    if strategy == 'dynamic':
+        size = get_dynamic_size(size, L=1280)
+    x = torch.rand(1, 3, *size, device=device)
+
+    if strategy == 'tiled':
+        x_lr = torch.rand(1, 3, *BASE_SIZES[mode], device=device)
+        fn = lambda: model.forward_tiled(x, x_lr, tile_size, overlap)
+    else:
+        fn = lambda: model(x)
+
+    try:
+        latency = timeit(fn, repeat=repeat, warmup=0, device=device)
+    except RuntimeError as e:
+        return {'case': 'tiled', 'strategy': strategy, 'size': list(size), 'error': str(e).split('\n')[0]}
+
+    return {'case': 'tiled', 'strategy': strategy, 'size': list(size), 'tile_size': tile_size,
+            'latency_ms': round(latency, 2), 'peak_memory_mb': round(peak_memory(device), 1)}
+
+def bench_tiled(args):
+    for strategy in ('dynamic', 'single', 'tiled'):
+        yield isolated(run_tiled, size=parse_size(args.size or '4096x6144'), tile_size=args.tile, overlap=args.overlap,
+                       strategy=strategy, mode=args.mode, device=args.device, repeat=args.repeat)
+
+def run_swin_mask(size, device='cpu', repeat=20):
+    """
+    Per forward cost of building the shifted window attention masks of every SwinB stage, with and without the cache.
+    """
+    window_size, shift_size = 12, 6
+    H, W = size[0] // 4, size[1] // 4
+    stages = []
+    for _ in range(4):
+        stages.append((int(np.ceil(H / window_size)) * window_size, int(np.ceil(W / window_size)) * window_size))
+        H, W = (H + 1) // 2, (W + 1) // 2
+
+    cache = AttnMaskCache()
+    uncached = lambda: [compute_attn_mask(Hp, Wp, window_size, shift_size, device=device) for Hp, Wp in stages]
+    cached = lambda: [cache.get(Hp, Wp, window_size, shift_size, device, torch.float32) for Hp, Wp in stages]
+
+    uncached_ms = timeit(uncached, repeat=repeat, device=device)
+    cached_ms = timeit(cached, repeat=repeat, device=device)
+    return {'case': 'swin_mask', 'size': list(size), 'uncached_ms': round(uncached_ms, 4),
+            'cached_ms': round(cached_ms, 4), 'saved_ms': round(uncached_ms - cached_ms, 4)}
+
+def bench_swin_mask(args):
+    for size in (args.size.split(',') if args.size else ['1024x1024', '1280x1920']):
+        yield run_swin_mask(parse_size(size), device=args.device, repeat=args.repeat)
+
+def run_precision(mode='base', device='cpu', precisions=('bf16', 'fp16'), images=None, ckpt=None, repeat=3):
+    """
+    Mean and max alpha error of reduced precision inference against fp32 on a fixed image set, with latency of each precision.
+    """
+    model = build_model(mode, device, ckpt)
+    x = load_images(BASE_SIZES[mode], images).to(device)
+
+    with torch.no_grad():
+        reference = torch.cat([model(i[None]) for i in x])
+    latency = timeit(lambda: model(x[:1]), repeat=repeat, device=device)
+    results = [{'case': 'precision', 'precision': 'fp32', 'mode': mode, 'size': BASE_SIZES[mode],
+                'latency_ms': round(latency, 2), 'images_per_sec': round(1000 / latency, 3)}]
+
+    for precision in precisions:
+        if precision == 'int8':
+            if torch.device(device).type != 'cpu':
+                results.append({'case': 'precision', 'precision': precision, 'mode': mode, 'error': 'not supported on {}'.format(device)})
+                continue
+            candidate = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            autocast = lambda: torch.autocast(device_type='cpu', enabled=False)
+        else:
+            dtype = get_autocast_dtype(precision, device)
+            if dtype is None:
+                results.append({'case': 'precision', 'precision': precision, 'mode': mode, 'error': 'not supported on {}'.format(device)})
+                continue
+            candidate = model
+            autocast = lambda: torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+        with torch.no_grad(), autocast():
+            pred = torch.cat([candidate(i[None]) for i in x]).float()
+
+        def fn():
+            with autocast():
+                candidate(x[:1])
+
+        error = (pred - reference).abs()
+        latency = timeit(fn, repeat=repeat, device=device)
+        results.append({'case': 'precision', 'precision': precision, 'mode': mode, 'size': BASE_SIZES[mode],
+                        'mean_alpha_error': round(error.mean().item(), 6), 'max_alpha_error': round(error.max().item(), 6),
+                        'latency_ms': round(latency, 2), 'images_per_sec': round(1000 / latency, 3)})
+    return results
+
+def bench_precision(args):
+    yield from run_precision(args.mode, args.device, images=args.images, ckpt=args.ckpt, repeat=args.repeat)
+
+def bench_int8(args):
+    # accuracy against fp32 and throughput of the dynamically quantized cpu engine at both resolutions
+    for mode in ('fast', 'base'):
+        yield from run_precision(mode, 'cpu', precisions=('int8',), images=args.images, ckpt=args.ckpt, repeat=args.repeat)
+
+def run_import(module, baseline='torch', repeat=3):
+    """
+    Median wall time of importing module in a fresh interpreter, on top of baseline which ComfyUI has already imported.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    code = "import time, {}; start = time.perf_counter(); import {}; print(time.perf_counter() - start)".format(baseline, module)
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True)
+        if out.returncode != 0:
+            return {'case': 'import', 'module': module, 'error': out.stderr.strip().split('\n')[-1]}
+        times.append(float(out.stdout.strip().split('\n')[-1]) * 1000)
+    return {'case': 'import', 'module': module, 'import_ms': round(sorted(times)[len(times) // 2], 2)}
+
+def bench_import(args):
+    # node registration only imports py.inspynet, the InSPyReNet stack is imported by the first load_model
+    deferred = run_import('py.inspynet', repeat=args.repeat)
+    eager = run_import('py.inspynet, py.inspyrenet', repeat=args.repeat)
+    yield deferred
+    yield eager
+    if 'import_ms' in deferred and 'import_ms' in eager:
+        yield {'case': 'import', 'startup_saving_ms': round(eager['import_ms'] - deferred['import_ms'], 2)}
+
+def run_load(ckpt, loader='pickle', mode='base', dtype=None):
+    """
+    Cold load time and peak RSS of building the model and loading ckpt, with the pickle checkpoint or the memory-mapped copy.
+    """
+    start = time.perf_counter()
+    model = InSPyReNet_SwinB(depth=64, pretrained=False, base_size=BASE_SIZES[mode], threshold=None)
+    if loader == 'pickle':
+        model.load_state_dict(torch.load(ckpt, map_location='cpu'), strict=True)
+    else:
+        model.load_state_dict(load_weights(ckpt, dtype=dtype), strict=True, assign=True)
+    elapsed = time.perf_counter() - start
+    return {'case': 'load', 'loader': loader, 'dtype': str(dtype), 'load_ms': round(elapsed * 1000, 2),
+            'peak_memory_mb': round(peak_memory('cpu'), 1)}
+
+def bench_load(args):
+    with tempfile.TemporaryDirectory() as root:
+        ckpt = args.ckpt
+        if ckpt is None:
+            ckpt = os.path.join(root, 'ckpt_{}.pth'.format(args.mode))
+            torch.save(build_model(args.mode).state_dict(), ckpt)
+        elif os.path.dirname(os.path.abspath(ckpt)) != root:
+            # converted copies are written next to the checkpoint, keep them out of the real cache directory
+            os.symlink(os.path.abspath(ckpt), os.path.join(root, os.path.basename(ckpt)))
+            ckpt = os.path.join(root, os.path.basename(ckpt))
+
+        yield isolated(run_load, ckpt=ckpt, loader='pickle', mode=args.mode)
+        # first mmap load converts the checkpoint, the following ones are the steady state
+        for dtype in (None, torch.float16):
+            for loader in ('convert', 'mmap'):
+                yield isolated(run_load, ckpt=ckpt, loader=loader, mode=args.mode, dtype=dtype)
+
+def run_pool(ckpt, workers, threads, mode='base', size=(1024, 1024), count=16, repeat=3):
+    """
+    Throughput of `RemoverPool` with workers processes sharing the given total number of threads.
+    """
+    from .pool import RemoverPool
+
+    imgs = torch.rand(count, *size, 3)
+    pool = RemoverPool(workers=workers, threads=max(1, threads // workers), mode=mode, ckpt=ckpt)
+    try:
+        latency = timeit(lambda: pool.predict(imgs, batch_size=1), repeat=repeat)
+    finally:
+        pool.close()
+    return {'case': 'pool', 'workers': workers, 'threads_per_worker': max(1, threads // workers), 'count': count,
+            'size': list(size), 'latency_ms': round(latency, 2), 'images_per_sec': round(count * 1000 / latency, 3)}
+
+def bench_pool(args):
+    workers = args.workers or os.cpu_count()
+    threads = torch.get_num_threads()
+    counts = sorted({2 ** i for i in range(int(np.log2(workers)) + 1)} | {workers})
+
+    with tempfile.TemporaryDirectory() as root:
+        ckpt = args.ckpt
+        if ckpt is None:
+            ckpt = os.path.join(root, 'ckpt_{}.pth'.format(args.mode))
+            torch.save(build_model(args.mode).state_dict(), ckpt)
+
+        baseline = None
+        for n in counts:
+            result = run_pool(ckpt, n, threads, mode=args.mode, size=parse_size(args.size or '1024x1024'),
+                              count=args.count, repeat=args.repeat)
+            baseline = baseline or result['images_per_sec']
+            result['speedup'] = round(result['images_per_sec'] / baseline, 2)
+            yield result
+
+def run_forward(mode, size, batch, device='cpu', repeat=3):
+    """
+    Latency and peak memory of `forward_inference` at a network input size and batch size.
+    """
+    model = build_model(mode, device)
+    x = torch.rand(batch, 3, *size, device=device)
+    latency = timeit(lambda: model.forward_inference(x), repeat=repeat, device=device)
+    return {'case': 'forward', 'mode': mode, 'size': list(size), 'batch': batch, 'device': str(device),
+            'latency_ms': round(latency, 2), 'images_per_sec': round(batch * 1000 / latency, 3),
+            'peak_memory_mb': round(peak_memory(device), 1)}
+
+def bench_forward(args, mode=None, sizes=None, batches=None):
+    mode = mode or args.mode
+    for size in sizes or parse_list(args.size, 'x'.join(map(str, BASE_SIZES[mode])), parse_size):
+        for batch in batches or parse_list(args.batch, '1,2,4'):
+            yield isolated(run_forward, mode=mode, size=size, batch=batch, device=args.device, repeat=args.repeat)
+
+def run_preprocess(size, batch, mode='base', device='cpu', repeat=3, root=None):
+    """
+    Latency of `Remover` pre-processing (resize and normalization to the network input) and composition of every output type.
+    """
+    remover = build_remover(mode, device, root)
+    imgs = torch.rand(batch, *size, 3, device=device)
+    uint8 = (imgs * 255).to(torch.uint8)
+    alpha = torch.rand(batch, *size, device=device)
+    network_size = remover.get_size(size)
+
+    result = {'case': 'preprocess', 'mode': mode, 'size': list(size), 'batch': batch, 'device': str(device),
+              'preprocess_ms': round(timeit(lambda: remover.preprocess(imgs, network_size), repeat=repeat, device=device), 3)}
+    for type in ('rgba', 'map', 'green', 'blur', 'overlay'):
+        result['{}_ms'.format(type)] = round(timeit(lambda: remover.composite(imgs, alpha, type), repeat=repeat, device=device), 3)
+    result['green_uint8_ms'] = round(timeit(lambda: remover.composite(uint8, alpha, 'green'), repeat=repeat, device=device), 3)
+    result['peak_memory_mb'] = round(peak_memory(device), 1)
+    return result
+
+def bench_preprocess(args):
+    with tempfile.TemporaryDirectory() as root:
+        for size in parse_list(args.size, '1080x1920,2160x3840', parse_size):
+            for batch in parse_list(args.batch, '1,4'):
+                yield isolated(run_preprocess, size=size, batch=batch, mode=args.mode, device=args.device, repeat=args.repeat, root=root)
+
+def run_refine(size, batch, threshold=0.5, device='cpu', repeat=3):
+    """
+    Latency of the batched threshold refinement, with its difference to the OpenCV reference if cv2.ximgproc is available.
+    """
+    from .refine import refine, refine_numpy
+
+    generator = torch.Generator().manual_seed(0)
+    pred = torch.rand(batch, 1, size[0] // 16, size[1] // 16, generator=generator)
+    pred = F.interpolate(pred, size, mode='bicubic', align_corners=False).clamp(0, 1).to(device)
+
+    latency = timeit(lambda: refine(pred, threshold), repeat=repeat, device=device)
+    result = {'case': 'refine', 'size': list(size), 'batch': batch, 'device': str(device),
+              'latency_ms': round(latency, 2), 'images_per_sec': round(batch * 1000 / latency, 3),
+              'peak_memory_mb': round(peak_memory(device), 1)}
+
+    if not hasattr(cv2, 'ximgproc'):
+        raise RuntimeError("cv2.ximgproc is missing for the parity reference, install opencv-contrib-python instead of opencv-python.")
+    reference = refine_numpy(pred[0, 0].double().cpu().numpy(), threshold)
+    error = np.abs(refine(pred[:1], threshold)[0, 0].double().cpu().numpy() - reference)
+    result.update(mean_parity_error=round(float(error.mean()), 6), max_parity_error=round(float(error.max()), 6))
+    return result
+
+def bench_refine(args):
+    for size in parse_list(args.size, '1024x1024,2160x3840', parse_size):
+        for batch in parse_list(args.batch, '1,4'):
+            yield isolated(run_refine, size=size, batch=batch, device=args.device, repeat=args.repeat)
+
+def reference_expand(pyr, x):
+    # zero upsampling and reflect padding of the upsampled image, as ImagePyramid.expand was first written
+    z = torch.zeros_like(x)
+    x = F.pixel_shuffle(torch.cat([x, z, z, z], dim=1), 2)
+    x = F.pad(x, (pyr.ksize // 2, ) * 4, mode='reflect')
+    return F.conv2d(x, pyr.kernel * 4, groups=pyr.channels)
+
+def reference_reduce(pyr, x):
+    x = F.pad(x, (pyr.ksize // 2, ) * 4, mode='reflect')
+    return F.conv2d(x, pyr.kernel, groups=pyr.channels)[:, :, ::2, ::2]
+
+def reference_transition(transition, x):
+    # OpenCV pads morphology with the identity of max / min, like kornia's geodesic border
+    kernel = transition.kernel.cpu().numpy().astype(np.uint8)
+    x = torch.sigmoid(x).cpu().numpy()
+    band = [cv2.dilate(m, kernel) - cv2.erode(m, kernel) for m in x.reshape(-1, *x.shape[-2:])]
+    return torch.from_numpy((np.stack(band) > .5).astype(np.float32)).view(x.shape)
+
+def run_pyramid(size, batch, device='cpu', repeat=3):
+    """
+    Latency of the image pyramid and transition kernels of the decoder against their reference implementations,
+    with the largest difference to the reference as the parity error.
+    """
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(batch, 1, *size, generator=generator).to(device)
+    low = torch.randn(batch, 1, size[0] // 2, size[1] // 2, generator=generator).to(device)
+    pyr = ImagePyramid(7, 1).to(device)
+
+    result = {'case': 'pyramid', 'size': list(size), 'batch': batch, 'device': str(device)}
+    for name, fn, reference, args in (('expand', pyr.expand, lambda y: reference_expand(pyr, y), (low, )),
+                                      ('reduce', pyr.reduce, lambda y: reference_reduce(pyr, y), (x, )),
+                                      ('reconstruct', pyr.reconstruct, lambda y, l: reference_expand(pyr, y) + l, (low, x))):
+        result['{}_ms'.format(name)] = round(timeit(lambda: fn(*args), repeat=repeat, device=device), 3)
+        result['{}_reference_ms'.format(name)] = round(timeit(lambda: reference(*args), repeat=repeat, device=device), 3)
+        result['{}_max_parity_error'.format(name)] = float((fn(*args) - reference(*args)).abs().max())
+
+    for k in (17, 9, 5):
+        transition = Transition(k).to(device)
+        result['transition{}_ms'.format(k)] = round(timeit(lambda: transition(x), repeat=repeat, device=device), 3)
+        result['transition{}_reference_ms'.format(k)] = round(timeit(lambda: reference_transition(transition, x), repeat=repeat, device=device), 3)
+        # sigmoid of the same input on either side, so the bands match exactly unless a border or footprint differs
+        result['transition{}_max_parity_error'.format(k)] = float((transition(x).cpu() - reference_transition(transition, x)).abs().max())
+    return result
+
+def bench_pyramid(args):
+    for size in parse_list(args.size, '512x512,1024x1024', parse_size):
+        for batch in parse_list(args.batch, '1,4'):
+            yield run_pyramid(size, batch, device=args.device, repeat=args.repeat)
+
+def reference_attention(q, k, v, attn_mask=None, scale=None):
+    # the explicit attention matrix, as the attention modules computed it before scaled_dot_product_attention
+    attn = (q @ k.transpose(-2, -1)) * (q.shape[-1] ** -.5 if scale is None else scale)
+    if attn_mask is not None:
+        attn = attn + attn_mask
+    return F.softmax(attn, dim=-1) @ v
+
+def run_attention(size, batch, device='cpu', repeat=3):
+    """
+    Latency and peak memory of the axis attention of the decoder at stage 2 and the shifted window attention of the
+    first SwinB stage, through scaled_dot_product_attention and through the explicit attention matrix.
+    """
+    from .modules import layers
+    from .backbones import SwinTransformer
+
+    generator = torch.Generator().manual_seed(0)
+    H, W = size[0] // 4, size[1] // 4
+    x = torch.randn(batch, 64, H, W, generator=generator).to(device)
+    hattn, wattn = SelfAttention(64, 'h').to(device).eval(), SelfAttention(64, 'w').to(device).eval()
+    for module in (hattn, wattn):
+        module.gamma.data.fill_(1)
+
+    window_size = 12
+    Hp, Wp = int(np.ceil(H / window_size)) * window_size, int(np.ceil(W / window_size)) * window_size
+    windows = torch.randn(batch * (Hp // window_size) * (Wp // window_size), window_size ** 2, 128, generator=generator).to(device)
+    mask = compute_attn_mask(Hp, Wp, window_size, window_size // 2, device=device)
+    wmsa = WindowAttention(128, (window_size, window_size), 4).to(device).eval()
+
+    cases = {'axis': lambda: wattn(hattn(x)), 'window': lambda: wmsa(windows, mask)}
+    result = {'case': 'attention', 'size': list(size), 'batch': batch, 'device': str(device)}
+    with torch.no_grad():
+        for name, fn in cases.items():
+            out = fn()
+            result['{}_ms'.format(name)] = round(timeit(fn, repeat=repeat, device=device), 3)
+
+            # the modules look up `attention` at call time, so patching it gives the explicit reference
+            fused = layers.attention
+            layers.attention = SwinTransformer.attention = reference_attention
+            try:
+                reference = fn()
+                result['{}_reference_ms'.format(name)] = round(timeit(fn, repeat=repeat, device=device), 3)
+            finally:
+                layers.attention = SwinTransformer.attention = fused
+            result['{}_max_parity_error'.format(name)] = float((out - reference).abs().max())
+    result['peak_memory_mb'] = round(peak_memory(device), 1)
+    return result
+
+def bench_attention(args):
+    for size in parse_list(args.size, '1024x1024,1280x1280', parse_size):
+        for batch in parse_list(args.batch, '1,4'):
+            yield isolated(run_attention, size=size, batch=batch, device=args.device, repeat=args.repeat)
+
+def run_fuse(mode, size, batch, device='cpu', repeat=3):
+    """
+    Latency of `forward_inference` with batch norms folded into the convs, and in channels last memory format on top,
+    with the largest difference to the plain model as the parity error.
+    """
+    model = build_model(mode, device)
+    # random weights come with identity batch norms, which would make the folding trivially exact
+    generator = torch.Generator().manual_seed(0)
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.copy_(torch.randn(module.num_features, generator=generator) * .1)
+            module.running_var.copy_(torch.rand(module.num_features, generator=generator) + .5)
+            module.weight.data.copy_(torch.rand(module.num_features, generator=generator) + .5)
+            module.bias.data.copy_(torch.randn(module.num_features, generator=generator) * .1)
+    x = torch.rand(batch, 3, *size, generator=generator).to(device)
+
+    result = {'case': 'fuse', 'mode': mode, 'size': list(size), 'batch': batch, 'device': str(device)}
+    with torch.no_grad():
+        reference = model.forward_inference(x)
+        result['plain_ms'] = round(timeit(lambda: model.forward_inference(x), repeat=repeat, device=device), 2)
+
+        fuse_conv_bn(model)
+        result['fused_ms'] = round(timeit(lambda: model.forward_inference(x), repeat=repeat, device=device), 2)
+        result['fused_max_parity_error'] = float((model.forward_inference(x) - reference).abs().max())
+
+        model = model.to(memory_format=torch.channels_last)
+        x = x.contiguous(memory_format=torch.channels_last)
+        result['channels_last_ms'] = round(timeit(lambda: model.forward_inference(x), repeat=repeat, device=device), 2)
+        result['channels_last_max_parity_error'] = float((model.forward_inference(x) - reference).abs().max())
+    result['peak_memory_mb'] = round(peak_memory(device), 1)
+    return result
+
+def bench_fuse(args):
+    for size in parse_list(args.size, 'x'.join(map(str, BASE_SIZES[args.mode])), parse_size):
+        for batch in parse_list(args.batch, '1,4'):
+            yield isolated(run_fuse, mode=args.mode, size=size, batch=batch, device=args.device, repeat=args.repeat)
+
+def bench_suite(args):
+    # forward at the configured size of both modes, then the cheap stages at their default sizes
+    for mode in BASE_SIZES:
+        yield from bench_forward(args, mode=mode, sizes=[BASE_SIZES[mode]], batches=parse_list(args.batch, '1,2,4'))
+    yield from bench_preprocess(args)
+    yield from bench_refine(args)
+    yield from bench_pyramid(args)
+    yield from bench_attention(args)
+    yield from bench_fuse(args)
+
+# largest accepted parity error of each case, checked with --check
+PARITY_TOLERANCE = {
+    'refine': {'mean_parity_error': 1e-3, 'max_parity_error': 1e-2},
+    # the fused pyramid differs from the reference in float32 summation order only, the transition band is exact
+    'pyramid': {'expand_max_parity_error': 1e-4, 'reduce_max_parity_error': 1e-4, 'reconstruct_max_parity_error': 1e-4,
+                'transition17_max_parity_error': 0.0, 'transition9_max_parity_error': 0.0, 'transition5_max_parity_error': 0.0},
+    # fused attention kernels only reorder the float32 reductions of the explicit attention matrix
+    'attention': {'axis_max_parity_error': 1e-4, 'window_max_parity_error': 1e-4},
+    # folding changes the float32 rounding of every conv, which the deep network carries through to the normalized map
+    'fuse': {'fused_max_parity_error': 1e-3, 'channels_last_max_parity_error': 1e-3},
+}
+
+def check(results):
+    """
+    Args:
+        results (list): results of this run
+    Returns:
+        list: descriptions of the parity errors above PARITY_TOLERANCE
+    """
+    failures = []
+    for result in results:
+        for field, tolerance in PARITY_TOLERANCE.get(result['case'], {}).items():
+            if field in result and result[field] > tolerance:
+                failures.append("{} {}: {} > {}".format(result_key(result), field, result[field], tolerance))
+    return failures
+
+# fields that are measured, every other field identifies a result when comparing runs
+MEASUREMENTS = ('ms', 'per_sec', 'memory_mb', 'error', 'speedup')
+
+def result_key(result):
+    return json.dumps({k: v for k, v in result.items() if not k.endswith(MEASUREMENTS)}, sort_keys=True)
+
+def compare(results, baseline):
+    """
+    Args:
+        results (list): results of this run
+        baseline (list): results of a previous run, e.g. another commit
+    Returns:
+        generator: ratio of every measurement to the baseline (< 1 is faster or smaller for latency and memory)
+    """
+    baseline = {result_key(result): result for result in baseline}
+    for result in results:
+        if result_key(result) not in baseline:
+            continue
+        previous = baseline[result_key(result)]
+        ratios = {k: round(v / previous[k], 3) for k, v in result.items()
+                  if k.endswith(MEASUREMENTS) and isinstance(v, (int, float)) and previous.get(k)}
+        yield dict(json.loads(result_key(result)), compare='ratio', **ratios)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="InSPyReNet benchmarks with random weights")
+    parser.add_argument('case', choices=['suite', 'forward', 'preprocess', 'refine', 'pyramid', 'attention', 'fuse', 'tiled', 'swin_mask', 'precision', 'int8', 'import', 'load', 'pool'])
+    parser.add_argument('--mode',    '-m', type=str, default='base', choices=list(BASE_SIZES.keys()))
+    parser.add_argument('--device',  '-D', type=str, default='cpu')
+    parser.add_argument('--repeat',  '-r', type=int, default=3)
+    parser.add_argument('--size',    '-s', type=str, default=None, help="input size as HxW, comma separated for several sizes")
+    parser.add_argument('--tile',          type=int, default=1024)
+    parser.add_argument('--overlap',       type=int, default=128)
+    parser.add_argument('--images',        type=str, default=None, help="directory of images for quality checks, seeded random images if not specified")
+    parser.add_argument('--ckpt',    '-c', type=str, default=None, help="checkpoint for quality checks, random weights if not specified")
+    parser.add_argument('--workers', '-w', type=int, default=None, help="maximum number of worker processes for the pool case, number of cpus if not specified")
+    parser.add_argument('--count',         type=int, default=16, help="number of images per batch")
+    parser.add_argument('--batch',   '-b', type=str, default=None, help="comma separated batch sizes")
+    parser.add_argument('--output',  '-o', type=str, default=None, help="write results and environment to this JSON file")
+    parser.add_argument('--compare',       type=str, default=None, help="JSON file of a previous run to compare the results with")
+    parser.add_argument('--check',         action='store_true', help="exit with an error if a parity error exceeds its tolerance")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    for result in globals()['bench_' + args.case](args):
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        for ratio in compare(results, baseline):
+            print(json.dumps(ratio))
+
+    if args.output is not None:
+        env = {'torch': torch.__version__, 'python': sys.version.split()[0], 'cpus': os.cpu_count(),
+               'threads': torch.get_num_threads(), 'device': args.device, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(args.output, 'w') as f:
+            json.dump({'env': env, 'case': args.case, 'results': results}, f, indent=1)
+
+    if args.check:
+        failures = check(results)
+        for failure in failures:
+            print("Parity check failed -> {}".format(failure))
+        if failures:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import os
+import hashlib
+import threading
+
+import numpy as np
+import torch
+
+from collections import OrderedDict
+
+from .utils import get_md5
+
+class MatteCache:
+    def __init__(self, root=None, budget=None):
+        """
+        Persistent cache of soft predictions keyed by image content and model fingerprint. predictions are stored before
+        refine and composition, so changing the threshold or the background still hits.
+
+        Args:
+            root (str, optional): cache directory. read from INSPYRENET_MATTE_CACHE_DIR environment variable if not specified,
+                                  matte_cache in the transparent-background home directory by default.
+            budget (int, optional): disk budget in MB. least recently used predictions are evicted when exceeded.
+                                    read from INSPYRENET_MATTE_CACHE_MB environment variable if not specified (default 2048).
+        """
+        if root is None:
+            cfg_path = os.environ.get('TRANSPARENT_BACKGROUND_FILE_PATH', os.path.abspath(os.path.expanduser('~')))
+            root = os.environ.get('INSPYRENET_MATTE_CACHE_DIR', os.path.join(cfg_path, ".transparent-background", "matte_cache"))
+        if budget is None:
+            budget = int(os.environ.get('INSPYRENET_MATTE_CACHE_MB', 2048))
+        self.root = root
+        self.budget = budget * 1024 ** 2
+        self.lock = threading.Lock()
+        self.entries = None
+        self.size = 0
+        self.digests = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load_index(self):
+        # least recently used first, hits touch the modification time of their file
+        files = []
+        if os.path.isdir(self.root):
+            for f in os.listdir(self.root):
+                if f.endswith('.npy'):
+                    stat = os.stat(os.path.join(self.root, f))
+                    files.append((stat.st_mtime, f[:-4], stat.st_size))
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(files))
+        self.size = sum(self.entries.values())
+
+    def fingerprint(self, remover, tile_size=None, latency=None):
+        """
+        Returns:
+            str: model side of the cache key. everything changing the soft prediction of the same image is a part of it.
+        """
+        if remover.ckpt not in self.digests:
+            os.makedirs(self.root, exist_ok=True)
+            self.digests[remover.ckpt] = get_md5(remover.ckpt, cache_dir=self.root)
+        return "{}:{}:{}:{}:{}:{}:{}".format(remover.mode, self.digests[remover.ckpt], remover.precision, remover.jit, remover.variant,
+                                             tile_size, latency)
+
+    @staticmethod
+    def key(img, fingerprint):
+        x = img.detach().cpu().contiguous()
+        digest = hashlib.sha1(fingerprint.encode("utf-8"))
+        digest.update(str((tuple(x.shape), str(x.dtype))).encode("utf-8"))
+        digest.update(x.numpy().data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, "{}.npy".format(key))
+
+    def get(self, key):
+        """
+        Returns:
+            torch.Tensor: cached soft prediction of shape [H, W], None if not cached
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load_index()
+
+            if key in self.entries:
+                try:
+                    pred = np.load(self.path(key))
+                    os.utime(self.path(key))
+                except (OSError, ValueError):
+                    self.size -= self.entries.pop(key)
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return torch.from_numpy(pred.astype(np.float32))
+
+            self.misses += 1
+            return None
+
+    def put(self, key, pred):
+        """
+        Args:
+            pred (torch.Tensor): soft prediction of shape [H, W], stored as float16
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load_index()
+            os.makedirs(self.root, exist_ok=True)
+
+            tmp_path = "{}.{}.tmp".format(self.path(key), os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, pred.detach().cpu().numpy().astype(np.float16))
+            os.replace(tmp_path, self.path(key))
+
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = os.path.getsize(self.path(key))
+            self.size += self.entries[key]
+            self.evict()
+
+    def evict(self):
+        # the most recently stored prediction always stays, even if it alone exceeds the budget
+        while len(self.entries) > 1 and self.size > self.budget:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def predict(self, remover, imgs, batch_size=8, tile_size=None, tile_overlap=128, latency=None):
+        """
+        Args:
+            remover (Remover): model to run on cache misses
+            imgs, batch_size, tile_size, tile_overlap, latency: see `Remover.predict`
+        Returns:
+            torch.Tensor or list: soft predictions as `Remover.predict`, only images missing from the cache are forwarded
+        """
+        fingerprint = self.fingerprint(remover, tile_size, latency)
+        keys = [self.key(img, fingerprint) for img in imgs]
+        preds = [self.get(key) for key in keys]
+
+        missing = [i for i, pred in enumerate(preds) if pred is None]
+        if len(missing) > 0:
+            x = imgs[missing] if torch.is_tensor(imgs) else [imgs[i] for i in missing]
+            for i, pred in zip(missing, remover.predict(x, batch_size=batch_size, tile_size=tile_size, tile_overlap=tile_overlap,
+                                                                latency=latency)):
+                # rounded like the stored copy, so a miss and later hits of the same image give the same matte
+                pred = pred.half().float()
+                self.put(keys[i], pred)
+                preds[i] = pred
+
+        preds = [pred.to(img.device) for img, pred in zip(imgs, preds)]
+        return torch.stack(preds) if torch.is_tensor(imgs) else preds
+
+    def clear(self):
+        with self.lock:
+            if self.entries is None:
+                self.load_index()
+            for key in self.entries:
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': 0 if self.entries is None else len(self.entries),
+            'disk_mb': round(self.size / 1024 ** 2, 1),
+            'budget_mb': round(self.budget / 1024 ** 2, 1),
+        }
+
+matte_cache = MatteCache()
@@ -0,0 +1,142 @@
+import os
+import cv2
+import torch
+
+import torch.nn.functional as F
+
+from collections import OrderedDict
+
+from .refine import gaussian_blur, erode
+
+COLORS = {"green": [120, 255, 155], "white": [255, 255, 255]}
+
+def blend(fg, bg, alpha):
+    """
+    Args:
+        fg (torch.Tensor): foreground of shape [B, H, W, 3], float in range 0 ~ 1 or uint8
+        bg (torch.Tensor): background broadcastable to fg, in the dtype of fg
+        alpha (torch.Tensor): alpha of shape [B, H, W, 1], float in range 0 ~ 1 for float fg, uint8 for uint8 fg
+    Returns:
+        torch.Tensor: fg * alpha + bg * (1 - alpha). uint8 inputs are blended in fixed point with rounding.
+    """
+    if fg.dtype == torch.uint8:
+        a = alpha.to(torch.int32)
+        out = fg.to(torch.int32) * a + bg.to(torch.int32) * (255 - a)
+        return torch.div(out + 127, 255, rounding_mode="floor").to(torch.uint8)
+    return fg * alpha + bg * (1 - alpha)
+
+def resize(x, size):
+    """
+    Args:
+        x (torch.Tensor): images of shape [B, H, W, C], float or uint8
+        size (tuple): height and width of the output
+    """
+    if tuple(x.shape[1:3]) == tuple(size):
+        return x
+    out = F.interpolate(x.permute(0, 3, 1, 2).float(), size, mode="bilinear", align_corners=False).permute(0, 2, 3, 1)
+    return out.round().clamp(0, 255).to(torch.uint8) if x.dtype == torch.uint8 else out
+
+class Compositor:
+    def __init__(self, maxsize=8):
+        """
+        Batched tensor compositor for every output type of `Remover`, in float32 or uint8 fixed point.
+
+        Args:
+            maxsize (int): number of background images kept after they are read and resized for an input size
+        """
+        self.maxsize = maxsize
+        self.backgrounds = OrderedDict()
+
+    def background(self, path, size, device, dtype):
+        """
+        Returns:
+            torch.Tensor: background image file of shape [1, *size, 3] in dtype range, read and resized once per size and device
+        """
+        key = (path, os.path.getmtime(path), tuple(size), str(device), dtype)
+        if key not in self.backgrounds:
+            bg = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+            bg = torch.from_numpy(cv2.resize(bg, tuple(size)[::-1])).to(device)[None]
+            self.backgrounds[key] = bg if dtype == torch.uint8 else bg.float() / 255
+            while len(self.backgrounds) > self.maxsize:
+                self.backgrounds.popitem(last=False)
+
+        self.backgrounds.move_to_end(key)
+        return self.backgrounds[key]
+
+    def __call__(self, img, alpha, type="rgba"):
+        """
+        Args:
+            img (torch.Tensor): images of shape [B, H, W, C], float in range 0 ~ 1, or uint8 for fixed point composition
+            alpha (torch.Tensor): alpha mattes of shape [B, H, W], float in range 0 ~ 1 (or uint8 with uint8 images)
+            type (str, list or torch.Tensor): output type as below.
+                        'rgba', 'map', 'green', 'white', 'blur', 'overlay' or a background image file, see `Remover.process`.
+                        [r, g, b] for a colour, a list of colours or a tensor of shape [B, 3] in range 0 ~ 255 for per frame colours.
+                        a tensor of shape [B, H', W', C] (or [1, H', W', C] for all images) in the range of img for background images.
+        Returns:
+            torch.Tensor: output of shape [B, H, W, 4] for 'rgba', [B, H, W, 3] otherwise, in the dtype of img on the device of alpha
+        """
+        img = img[..., :3].to(alpha.device)
+        uint8 = img.dtype == torch.uint8
+        if not uint8:
+            img = img.float()
+            alpha = alpha.float()
+        elif alpha.dtype != torch.uint8:
+            alpha = (alpha.float() * 255).round().clamp(0, 255).to(torch.uint8)
+        a = alpha.unsqueeze(-1)
+
+        if isinstance(type, str) and type.startswith("["):
+            type = [int(i) for i in type[1:-1].split(",")]
+
+        if torch.is_tensor(type) and type.dim() == 4:
+            bg = resize(type[..., :3].to(img.device), img.shape[1:3])
+            bg = bg if uint8 else bg.float()
+            if len(bg) != len(img):
+                bg = bg[torch.arange(len(img), device=bg.device) % len(bg)]
+
+        elif isinstance(type, str) and type == "map":
+            return a.expand(*alpha.shape, 3).clone()
+
+        elif isinstance(type, str) and type == "rgba":
+            return torch.cat([img, a], dim=-1)
+
+        elif (isinstance(type, str) and type in COLORS) or isinstance(type, (list, tuple)) or torch.is_tensor(type):
+            color = torch.as_tensor(COLORS.get(type, type) if isinstance(type, str) else type, dtype=torch.float32, device=img.device)
+            if color.dim() == 2:
+                # per frame colours
+                color = color[:, None, None, :]
+            bg = color.round().to(torch.uint8) if uint8 else color / 255
+
+        elif type == "blur":
+            x = img.permute(0, 3, 1, 2).float()
+            bg = gaussian_blur(x, sigma=15).permute(0, 2, 3, 1)
+            bg = bg.round().clamp(0, 255).to(torch.uint8) if uint8 else bg
+
+        elif type == "overlay":
+            return self.overlay(img, alpha)
+
+        elif isinstance(type, str) and type.lower().endswith((".jpg", ".jpeg", ".png")):
+            bg = self.background(type, img.shape[1:3], img.device, img.dtype)
+
+        else:
+            raise ValueError("Unknown output type {}.".format(type))
+
+        return blend(img, bg, a)
+
+    def overlay(self, img, alpha):
+        # translucent green over the object, with the object edges in green
+        uint8 = img.dtype == torch.uint8
+        green = torch.tensor(COLORS["green"], device=img.device)
+        if uint8:
+            bg = torch.div(img.to(torch.int32) + green, 2, rounding_mode="floor").to(torch.uint8)
+            binary = (alpha > 127).float()
+            green = green.to(torch.uint8)
+        else:
+            bg = (img + green / 255) / 2
+            binary = (alpha > 0.5).float()
+            green = green / 255
+
+        out = blend(bg, img, alpha.unsqueeze(-1))
+        # one pixel inner contour of the hard mask, in place of cv2.Canny on the binary mask
+        edge = (binary[:, None] - erode(binary[:, None], 3))[:, 0] > 0
+        out[edge] = green
+        return out
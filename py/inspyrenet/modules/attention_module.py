@@ -75,24 +75,20 @@ class SICA(nn.Module):
             shape = (h, w)
             shape_mul = h * w        
         
-        f = F.interpolate(x, size=shape, mode='bilinear', align_corners=False).view(b, shape_mul, -1)
-        prob = F.interpolate(prob, size=shape, mode='bilinear', align_corners=False).view(b, self.ctx, shape_mul)
+        f = F.interpolate(x, size=shape, mode='bilinear', align_corners=False).reshape(b, shape_mul, -1)
+        prob = F.interpolate(prob, size=shape, mode='bilinear', align_corners=False).reshape(b, self.ctx, shape_mul)
         
         # compute context vector
         context = torch.bmm(prob, f).permute(0, 2, 1).unsqueeze(3) # b, 3, c
 
         # k q v compute
-        query = self.conv_query(x).view(b, self.depth, -1).permute(0, 2, 1)
-        key = self.conv_key(context).view(b, self.depth, -1)
-        value = self.conv_value(context).view(b, self.depth, -1).permute(0, 2, 1)
+        query = self.conv_query(x).reshape(b, 1, self.depth, -1).transpose(-2, -1)
+        key = self.conv_key(context).reshape(b, 1, self.depth, -1).transpose(-2, -1)
+        value = self.conv_value(context).reshape(b, 1, self.depth, -1).transpose(-2, -1)
 
-        # compute similarity map
-        sim = torch.bmm(query, key) # b, hw, c x b, c, 2
-        sim = (self.depth ** -.5) * sim
-        sim = F.softmax(sim, dim=-1)
-
-        # compute refined feature
-        context = torch.bmm(sim, value).permute(0, 2, 1).contiguous().view(b, -1, h, w)
+        # compute similarity map and refined feature, softmax(q @ k^T / sqrt(depth)) @ v
+        context = attention(query, key, value) # b, 1, hw, c
+        context = context.transpose(-2, -1).reshape(b, -1, h, w)
         context = self.conv_out1(context)
         
         x = torch.cat([x, context], dim=1)
@@ -5,9 +5,61 @@ import torch.nn.functional as F
 import cv2
 import numpy as np
 
-from kornia.morphology import dilation, erosion
+from functools import wraps
+from packaging import version
 from torch.nn.parameter import Parameter
 
+# fused attention from torch 2.0, with an explicit scale from torch 2.1
+SDPA = hasattr(F, 'scaled_dot_product_attention')
+SDPA_SCALE = SDPA and version.parse(torch.__version__) >= version.parse("2.1")
+
+def autocast_enabled(device_type):
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # before torch 2.4 there is no device type argument
+        if device_type == "cuda":
+            return torch.is_autocast_enabled()
+        elif device_type == "cpu":
+            return torch.is_autocast_cpu_enabled()
+        return False
+
+def float32(fn):
+    """ Run fn in float32 with autocast disabled, for numerically sensitive parts of reduced precision inference """
+    @wraps(fn)
+    def wrapper(self, *args):
+        device_type = next(a.device.type for a in args if torch.is_tensor(a))
+        args = [a.float() if torch.is_tensor(a) else a for a in args]
+        if not autocast_enabled(device_type):
+            # nothing to disable, and torch.autocast raises for device types without autocast (mps before torch 2.5)
+            return fn(self, *args)
+        with torch.autocast(device_type=device_type, enabled=False):
+            return fn(self, *args)
+    return wrapper
+
+def attention(q, k, v, attn_mask=None, scale=None):
+    """ softmax(q @ k^T * scale + attn_mask) @ v through the flash / memory efficient kernels of
+    F.scaled_dot_product_attention if available, so the attention matrix is not materialized
+
+    Args:
+        q (torch.Tensor): query with shape of (..., L, E)
+        k (torch.Tensor): key with shape of (..., S, E)
+        v (torch.Tensor): value with shape of (..., S, Ev)
+        attn_mask (torch.Tensor | None): additive mask broadcastable to (..., L, S)
+        scale (float | None): E ** -0.5 if None
+    Returns:
+        torch.Tensor: output with shape of (..., L, Ev)
+    """
+    if SDPA_SCALE or (SDPA and scale is None):
+        if attn_mask is not None:
+            attn_mask = attn_mask.to(q.dtype)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, **({} if scale is None else {'scale': scale}))
+
+    attn = (q * (q.shape[-1] ** -.5 if scale is None else scale)) @ k.transpose(-2, -1)
+    if attn_mask is not None:
+        attn = attn + attn_mask
+    return attn.softmax(dim=-1) @ v
+
 class ImagePyramid:
     def __init__(self, ksize=7, sigma=1, channels=1):
         self.ksize = ksize
@@ -30,19 +82,26 @@ class ImagePyramid:
         self.to(device="cuda:{}".format(idx))
         return self
 
+    @float32
     def expand(self, x):
-        z = torch.zeros_like(x)
-        x = torch.cat([x, z, z, z], dim=1)
-        x = F.pixel_shuffle(x, 2)
-        x = F.pad(x, (self.ksize // 2, ) * 4, mode='reflect')
-        x = F.conv2d(x, self.kernel * 4, groups=self.channels)
-        return x
+        # transposed convolution of x is the convolution of zero upsampled x. reflect padding of the upsampled image
+        # lands on x as reflect-101 padding on the top / left and symmetric padding on the bottom / right, so x is
+        # padded instead, without building and padding the 4x larger upsampled image
+        H, W = x.shape[-2:]
+        p = self.ksize // 2
+        a, b = p // 2, p - p // 2
+        x = torch.cat([x[..., 1:a + 1, :].flip(-2), x, x[..., H - b:, :].flip(-2)], dim=-2)
+        x = torch.cat([x[..., 1:a + 1].flip(-1), x, x[..., W - b:].flip(-1)], dim=-1)
+        x = F.conv_transpose2d(x, self.kernel * 4, stride=2, groups=self.channels)
+
+        offset = self.ksize - 1 - p + 2 * a
+        return x[..., offset:offset + 2 * H, offset:offset + 2 * W]
 
+    @float32
     def reduce(self, x):
+        # strided convolution only computes the outputs that are kept
         x = F.pad(x, (self.ksize // 2, ) * 4, mode='reflect')
-        x = F.conv2d(x, self.kernel, groups=self.channels)
-        x = x[:, :, ::2, ::2]
-        return x
+        return F.conv2d(x, self.kernel, stride=2, groups=self.channels)
 
     def deconstruct(self, x):
         reduced_x = self.reduce(x)
@@ -54,15 +113,53 @@ class ImagePyramid:
         laplacian_x = x - expanded_reduced_x
         return reduced_x, laplacian_x
 
+    @float32
     def reconstruct(self, x, laplacian_x):
         expanded_x = self.expand(x)
-        if laplacian_x.shape != expanded_x:
+        if laplacian_x.shape != expanded_x.shape:
             laplacian_x = F.interpolate(laplacian_x, expanded_x.shape[-2:], mode='bilinear', align_corners=True)
-        return expanded_x + laplacian_x
+        return expanded_x.add_(laplacian_x)
+
+def decompose(kernel):
+    """
+    Args:
+        kernel (np.ndarray): symmetric binary structuring element whose rows get narrower away from the center, e.g. cv2.MORPH_ELLIPSE
+    Returns:
+        list: (height, width) of centered rectangles whose union is the kernel, so flat morphology with the kernel
+              is the max over the rectangles of separable max-pools
+    """
+    cy, cx = kernel.shape[0] // 2, kernel.shape[1] // 2
+    half = {}
+    for r, row in enumerate(kernel):
+        cols = np.nonzero(row)[0]
+        if len(cols) > 0:
+            half[abs(r - cy)] = max(half.get(abs(r - cy), 0), cx - int(cols[0]))
+
+    rects = sorted({(2 * max(r for r, v in half.items() if v >= w) + 1, 2 * w + 1) for w in half.values()})
+
+    union = np.zeros_like(kernel)
+    for h, w in rects:
+        union[cy - h // 2:cy + h // 2 + 1, cx - w // 2:cx + w // 2 + 1] = 1
+    if not np.array_equal(union, kernel != 0):
+        raise ValueError("structuring element cannot be decomposed into centered rectangles.")
+    return rects
+
+def dilate(x, rects):
+    # max_pool2d pads with -inf, so the border never wins, like the geodesic border of kornia
+    out = None
+    for h, w in rects:
+        y = F.max_pool2d(x, (1, w), stride=1, padding=(0, w // 2)) if w > 1 else x
+        y = F.max_pool2d(y, (h, 1), stride=1, padding=(h // 2, 0)) if h > 1 else y
+        out = y if out is None else torch.maximum(out, y)
+    return out
+
+def erode(x, rects):
+    return -dilate(-x, rects)
 
 class Transition:
     def __init__(self, k=3):
         self.kernel = torch.tensor(cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k, k))).float()
+        self.rects = decompose(self.kernel.numpy())
         
     def to(self, device):
         self.kernel = self.kernel.to(device)
@@ -72,13 +169,30 @@ class Transition:
         self.to(device="cuda:{}".format(idx))
         return self
         
+    @float32
     def __call__(self, x):
         x = torch.sigmoid(x)
-        dx = dilation(x, self.kernel)
-        ex = erosion(x, self.kernel)
+        dx = dilate(x, self.rects)
+        ex = erode(x, self.rects)
         
         return ((dx - ex) > .5).float()
 
+def fold_batch_norm(weight, bias, bn_weight, bn_bias, running_mean, running_var, eps=1e-5):
+    """
+    Args:
+        weight (torch.Tensor): conv weight of shape [C_out, C_in, kH, kW]
+        bias (torch.Tensor | None): conv bias of shape [C_out]
+        bn_weight, bn_bias, running_mean, running_var (torch.Tensor): affine parameters and statistics of the following batch norm
+        eps (float): eps of the batch norm
+    Returns:
+        tuple: weight and bias of a single conv computing the conv followed by the batch norm in inference, folded in float64
+    """
+    scale = bn_weight.double() / torch.sqrt(running_var.double() + eps)
+    folded_bias = bn_bias.double() - running_mean.double() * scale
+    if bias is not None:
+        folded_bias = folded_bias + bias.double() * scale
+    return (weight.double() * scale.view(-1, 1, 1, 1)).to(weight.dtype), folded_bias.to(weight.dtype)
+
 class Conv2d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, groups=1, padding='same', bias=False, bn=True, relu=False):
         super(Conv2d, self).__init__()
@@ -130,6 +244,31 @@ class Conv2d(nn.Module):
     def reset_parameters(self):
         nn.init.kaiming_normal_(self.conv.weight)
 
+    @torch.no_grad()
+    def fuse(self):
+        """ Fold the batch norm into the conv for inference, saving a read and write of the output feature map """
+        if self.bn is None:
+            return self
+
+        weight, bias = fold_batch_norm(self.conv.weight, self.conv.bias, self.bn.weight, self.bn.bias,
+                                       self.bn.running_mean, self.bn.running_var, self.bn.eps)
+        self.conv.weight = Parameter(weight)
+        self.conv.bias = Parameter(bias)
+        self.bn = None
+        return self
+
+def fuse_conv_bn(model):
+    """
+    Args:
+        model (torch.nn.Module): model in eval mode
+    Returns:
+        torch.nn.Module: the same model with the batch norm of every `Conv2d` folded into its conv, see `Conv2d.fuse`
+    """
+    for module in model.modules():
+        if isinstance(module, Conv2d):
+            module.fuse()
+    return model
+
 
 class SelfAttention(nn.Module):
     def __init__(self, in_channels, mode='hw', stage_size=None):
@@ -142,7 +281,6 @@ class SelfAttention(nn.Module):
         self.value_conv = Conv2d(in_channels, in_channels, kernel_size=(1, 1))
 
         self.gamma = Parameter(torch.zeros(1))
-        self.softmax = nn.Softmax(dim=-1)
         
         self.stage_size = stage_size
 
@@ -155,17 +293,15 @@ class SelfAttention(nn.Module):
         if 'w' in self.mode:
             axis *= width
 
-        view = (batch_size, -1, axis)
-
-        projected_query = self.query_conv(x).view(*view).permute(0, 2, 1)
-        projected_key = self.key_conv(x).view(*view)
+        view = (batch_size, 1, -1, axis)
 
-        attention_map = torch.bmm(projected_query, projected_key)
-        attention = self.softmax(attention_map)
-        projected_value = self.value_conv(x).view(*view)
+        # unscaled attention over the axis, (b, 1, axis, c') for the fused kernels
+        projected_query = self.query_conv(x).reshape(*view).transpose(-2, -1)
+        projected_key = self.key_conv(x).reshape(*view).transpose(-2, -1)
+        projected_value = self.value_conv(x).reshape(*view).transpose(-2, -1)
 
-        out = torch.bmm(projected_value, attention.permute(0, 2, 1))
-        out = out.view(batch_size, channel, height, width)
+        out = attention(projected_query, projected_key, projected_value, scale=1.0)
+        out = out.transpose(-2, -1).reshape(batch_size, channel, height, width)
 
         out = self.gamma * out + x
         return out
@@ -0,0 +1,192 @@
+import os
+import sys
+import math
+import queue
+import runpy
+import threading
+
+import torch
+import torch.multiprocessing as mp
+
+from .Remover import Remover
+
+class RemoverPool:
+    def __init__(self, workers=2, threads=None, **kwargs):
+        """
+        Pool of worker processes, each holding its own cpu model with its own thread budget. batches are split across the
+        workers and reassembled in order. weights are memory-mapped from the converted checkpoint (see `load_weights`),
+        so the workers share their pages through the page cache instead of holding a copy each.
+
+        Args:
+            workers (int): number of worker processes
+            threads (int, optional): intra-op threads of each worker. threads of this process divided by workers if not specified.
+            kwargs: keyword arguments of `Remover`. the model of this process is used for refine and composition.
+        """
+        self.kwargs = dict(kwargs, device="cpu")
+        self.remover = Remover(**self.kwargs)
+        self.workers = workers
+        self.threads = threads or max(1, torch.get_num_threads() // workers)
+        self.lock = threading.Lock()
+        self.processes = []
+
+        # workers import this package as top-level `inspyrenet` from the py directory
+        py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if py_dir not in sys.path:
+            sys.path.append(py_dir)
+
+        self.start()
+        print("Settings -> Workers={}, Threads={}".format(workers, self.threads))
+
+    def start(self):
+        """
+        Starts the worker processes. queues are created anew, so results of a previous run of the workers are never mixed in.
+        """
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.processes = []
+        for _ in range(self.workers):
+            args = {"kwargs": self.kwargs, "threads": self.threads, "tasks": self.tasks, "results": self.results}
+            process = ctx.Process(
+                target=runpy.run_module,
+                args=("inspyrenet.worker",),
+                kwargs={"init_globals": {"WORKER_ARGS": args}, "run_name": "__main__"},
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+        for _ in range(self.workers):
+            try:
+                self.get()
+            except RuntimeError:
+                raise RuntimeError("InSPyReNet worker failed to start.")
+
+    def __getattr__(self, name):
+        # everything else behaves like the model of this process
+        if name in ("remover", "processes", "kwargs"):
+            raise AttributeError(name)
+        return getattr(self.remover, name)
+
+    @property
+    def alive(self):
+        return len(self.processes) > 0
+
+    def get(self, timeout=1):
+        """
+        Returns:
+            tuple: next (index, output, error) of the results queue
+        Raises:
+            RuntimeError: if a worker died, e.g. killed for running out of memory. the workers are stopped, as tasks of the
+                          dead worker are lost and results of the others would be mixed into the next call. they are
+                          started again by the next call.
+        """
+        while True:
+            try:
+                return self.results.get(timeout=timeout)
+            except queue.Empty:
+                dead = [process.exitcode for process in self.processes if process.exitcode is not None]
+                if dead:
+                    self.close()
+                    raise RuntimeError("InSPyReNet worker died with exit code {}, workers restart on the next call.".format(dead[0]))
+
+    def map(self, method, imgs, chunk_size, **kwargs):
+        """
+        Args:
+            method (str): `Remover` method run by the workers on chunks of imgs
+            imgs (torch.Tensor or list): images split along the batch dimension
+            chunk_size (int): number of images per task
+        Returns:
+            list: outputs of each chunk in order
+        """
+        chunks = [imgs[i:i + chunk_size] for i in range(0, len(imgs), chunk_size)]
+        with self.lock:
+            # workers stopped by `close` (registry eviction) or by a dead worker are started again, as callers like
+            # cached ComfyUI node outputs keep using the pool
+            if not self.alive:
+                self.start()
+            for index, chunk in enumerate(chunks):
+                self.tasks.put((index, method, (chunk,), kwargs))
+
+            outputs, error = [None] * len(chunks), None
+            for _ in chunks:
+                index, output, traceback = self.get()
+                outputs[index] = output
+                error = error or traceback
+
+        if error is not None:
+            raise RuntimeError("InSPyReNet worker failed:\n{}".format(error))
+        return outputs
+
+    def predict(self, imgs, batch_size=8, tile_size=None, tile_overlap=128, latency=None):
+        """
+        Args: see `Remover.predict`
+        Returns:
+            torch.Tensor or list: soft predictions as `Remover.predict`, computed by the workers
+        """
+        chunk_size = max(1, min(batch_size, math.ceil(len(imgs) / self.workers)))
+        preds = self.map("predict", imgs, chunk_size, batch_size=batch_size, tile_size=tile_size, tile_overlap=tile_overlap,
+                         latency=latency)
+        if torch.is_tensor(imgs):
+            return torch.cat(preds).to(imgs.device)
+        return [pred for chunk in preds for pred in chunk]
+
+    def call(self, method, *args, **kwargs):
+        """
+        Returns:
+            object: output of a single `Remover` call run by one of the workers
+        """
+        with self.lock:
+            if not self.alive:
+                self.start()
+            self.tasks.put((0, method, args, kwargs))
+            _, output, error = self.get()
+
+        if error is not None:
+            raise RuntimeError("InSPyReNet worker failed:\n{}".format(error))
+        return output
+
+    def calibrate(self, *args, **kwargs):
+        """
+        Args: see `Remover.calibrate`
+        Returns:
+            tuple: cost model of the workers, which run with their own thread budget. it is measured by a single worker while
+                   the others are idle, and the others load it from the cost model cache on their first budgeted request.
+        """
+        return self.call("calibrate", *args, **kwargs)
+
+    def process_frames(self, *args, **kwargs):
+        """
+        Args: see `Remover.process_frames`
+        Returns:
+            tuple: as `Remover.process_frames`. keyframes are inferred by the workers through `predict`, keyframe selection,
+                   refine and composition run in this process.
+        """
+        return Remover.process_frames(self, *args, **kwargs)
+
+    def process_batch(self, imgs, type="rgba", threshold=None, batch_size=8, tile_size=None, tile_overlap=128, latency=None):
+        """
+        Args: see `Remover.process_batch`
+        Returns:
+            tuple: output images and alpha mattes as `Remover.process_batch`. only the network runs on the workers,
+                   refine and composition run in this process.
+        """
+        preds = self.predict(imgs, batch_size=batch_size, tile_size=tile_size, tile_overlap=tile_overlap, latency=latency)
+        return self.remover.process_preds(imgs, preds, type=type, threshold=threshold, batch_size=batch_size)
+
+    def close(self):
+        # only the workers are stopped, the next call starts them again
+        for process in self.processes:
+            if process.exitcode is None:
+                self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
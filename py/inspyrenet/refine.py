@@ -0,0 +1,155 @@
+import cv2
+import torch
+
+import numpy as np
+import torch.nn.functional as F
+
+def gaussian_kernel(sigma, dtype=torch.float32, device=None):
+    # same kernel size rule as cv2.GaussianBlur with ksize=(0, 0) for floating point images
+    ksize = int(round(sigma * 4 * 2 + 1)) | 1
+    x = torch.arange(ksize, dtype=torch.float64, device=device) - (ksize - 1) / 2
+    k = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return (k / k.sum()).to(dtype)
+
+def gaussian_blur(x, sigma):
+    """
+    Args:
+        x (torch.Tensor): tensor of shape [B, C, H, W]
+        sigma (float): standard deviation of the gaussian kernel
+    Returns:
+        torch.Tensor: blurred tensor, with the same reflect-101 border as cv2.GaussianBlur
+    """
+    k = gaussian_kernel(sigma, dtype=x.dtype, device=x.device)
+    c, r = x.shape[1], len(k) // 2
+    x = F.pad(x, (r, r, r, r), mode='reflect' if min(x.shape[-2:]) > r else 'replicate')
+    x = F.conv2d(x, k.view(1, 1, 1, -1).repeat(c, 1, 1, 1), groups=c)
+    x = F.conv2d(x, k.view(1, 1, -1, 1).repeat(c, 1, 1, 1), groups=c)
+    return x
+
+def dilate(x, ksize):
+    # max_pool2d pads with -inf, so the border never wins, which matches cv2.dilate default border
+    return F.max_pool2d(x, ksize, stride=1, padding=ksize // 2)
+
+def erode(x, ksize):
+    return -F.max_pool2d(-x, ksize, stride=1, padding=ksize // 2)
+
+def pad_symmetric(x, r):
+    # cv2.BORDER_REFLECT (edge pixel repeated), which F.pad does not provide
+    x = torch.cat([x[..., :, :r].flip(-1), x, x[..., :, -r:].flip(-1)], dim=-1)
+    x = torch.cat([x[..., :r, :].flip(-2), x, x[..., -r:, :].flip(-2)], dim=-2)
+    return x
+
+def box_filter(x, r):
+    return F.avg_pool2d(pad_symmetric(x, r), 2 * r + 1, stride=1)
+
+def guided_filter(guide, src, r, eps):
+    """
+    Args:
+        guide (torch.Tensor): single channel guide image of shape [B, 1, H, W]
+        src (torch.Tensor): image to be filtered of shape [B, 1, H, W]
+        r (int): radius of the box window
+        eps (float): regularization term, in the same scale as the input values
+    Returns:
+        torch.Tensor: filtered image, box filter implementation of cv2.ximgproc.createGuidedFilter(guide, r, eps).filter(src)
+    """
+    mean_i = box_filter(guide, r)
+    mean_p = box_filter(src, r)
+    var_i = box_filter(guide * guide, r) - mean_i * mean_i
+    cov_ip = box_filter(guide * src, r) - mean_i * mean_p
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return box_filter(a, r) * guide + box_filter(b, r)
+
+def refine(pred, threshold, kernels=(3, 5)):
+    """
+    Args:
+        pred (torch.Tensor): soft prediction of shape [B, 1, H, W] in range 0 ~ 1
+        threshold (float or str): threshold value (0.0 ~ 1.0)
+        kernels (tuple): kernel sizes of the multi-scale edge detection
+    Returns:
+        torch.Tensor: prediction with hard edges w.r.t the threshold, blended with the soft prediction around the edges.
+                      batched torch port of `refine_numpy`, running on the device of the prediction.
+    """
+    original_pred = pred
+    binary_pred = (pred > float(threshold) * 0.8).to(pred.dtype)
+
+    # multi-scale edge region
+    edge_region = None
+    for k in kernels:
+        edge = dilate(binary_pred, k) - erode(binary_pred, k)
+        edge_region = edge if edge_region is None else torch.maximum(edge_region, edge)
+
+    structure_weight = gaussian_blur(original_pred, sigma=0.5)
+    blend_mask = gaussian_blur(edge_region, sigma=1.0) * structure_weight
+    blend_mask = torch.sigmoid(5.0 * (blend_mask - 0.3))
+
+    pred = binary_pred * 0.7 + original_pred * 0.3
+    pred = pred * (1 - blend_mask) + original_pred * blend_mask
+
+    # structure preserving filter on 8-bit values, like the OpenCV implementation
+    guide = torch.floor(original_pred * 255)
+    pred = torch.floor(pred * 255)
+    pred = guided_filter(guide, pred, 5, 1e-2)
+    pred = torch.round(pred).clamp(0, 255) / 255.0
+
+    pred = torch.maximum(pred, original_pred * 0.5)
+    return pred.clamp(0, 1)
+
+def refine_numpy(pred, threshold):
+    """
+    Args:
+        pred (np.ndarray): soft prediction of shape [H, W]
+        threshold (float or str): threshold value (0.0 ~ 1.0)
+    Returns:
+        np.ndarray: reference NumPy / OpenCV implementation of `refine` for a single image
+    """
+    # 保存原始预测值
+    original_pred = pred.copy()
+
+    # 降低阈值以保留更多细节
+    binary_pred = (pred > float(threshold) * 0.8).astype(np.float64)  # 降低阈值
+
+    # 多尺度边缘检测 - 使用更小的kernel以保留细节
+    kernels = [(3,3), (5,5)]  # 减少kernel大小
+    edge_regions = []
+
+    for k_size in kernels:
+        kernel = np.ones(k_size, np.uint8)
+        dilated = cv2.dilate(binary_pred, kernel)
+        eroded = cv2.erode(binary_pred, kernel)
+        edge_region = dilated - eroded
+        edge_regions.append(edge_region)
+
+    # 融合多尺度边缘
+    edge_region = np.maximum.reduce(edge_regions)
+
+    # 计算结构相似度权重 - 减小模糊程度
+    structure_weight = cv2.GaussianBlur(original_pred, (0, 0), sigmaX=0.5)  # 减小sigma
+
+    # 边缘区域的自适应blend
+    blend_mask = cv2.GaussianBlur(edge_region, (0, 0), sigmaX=1.0)  # 减小sigma
+    blend_mask = blend_mask * structure_weight
+
+    # 使用更温和的sigmoid过渡
+    alpha = 5.0  # 降低alpha值使过渡更平滑
+    blend_mask = 1 / (1 + np.exp(-alpha * (blend_mask - 0.3)))  # 调整偏移值
+
+    # 在边缘区域使用加权融合，保留更多原始预测值
+    pred = binary_pred * 0.7 + original_pred * 0.3  # 添加原始预测值的权重
+    pred = pred * (1 - blend_mask) + original_pred * blend_mask
+
+    # 应用结构保持滤波 - 使用更大的半径
+    guide = (original_pred * 255).astype(np.uint8)
+    pred = (pred * 255).astype(np.uint8)
+    guided_filter = cv2.ximgproc.createGuidedFilter(guide, 5, 1e-2)  # 增加半径和epsilon
+    pred = guided_filter.filter(pred)
+    pred = pred.astype(np.float64) / 255.0
+
+    # 最后的调整以确保主体被保留
+    pred = np.maximum(pred, original_pred * 0.5)  # 确保原始预测值的一定比例被保留
+
+    # 确保值在 0-1 范围内
+    pred = np.clip(pred, 0, 1)
+
+    return pred
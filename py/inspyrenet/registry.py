@@ -0,0 +1,128 @@
+import os
+import time
+import warnings
+import threading
+
+import torch
+
+from collections import OrderedDict
+
+from .Remover import Remover
+from .utils import get_device
+
+class ModelRegistry:
+    def __init__(self, budget=None):
+        """
+        Process-wide cache of Remover instances shared by every loader node and workflow.
+
+        Args:
+            budget (int, optional): memory budget in MB for all cached models. least recently used models are evicted when exceeded.
+                                    read from INSPYRENET_CACHE_BUDGET_MB environment variable if not specified (default 4096).
+        """
+        if budget is None:
+            budget = int(os.environ.get('INSPYRENET_CACHE_BUDGET_MB', 4096))
+        self.budget = budget * 1024 ** 2
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def get(self, mode="base", jit=False, device=None, ckpt=None, workers=0, **kwargs):
+        """
+        Args:
+            mode, jit, device, ckpt: see `Remover`
+            workers (int): number of cpu worker processes splitting each batch, see `RemoverPool`. ignored on other devices.
+            kwargs: extra keyword arguments passed to `Remover`, also used as a part of the cache key
+        Returns:
+            Remover: cached instance if available, otherwise a newly loaded one
+        """
+        device = get_device(device)
+        if ckpt is not None:
+            ckpt = os.path.abspath(ckpt)
+        if workers > 1 and torch.device(device).type != "cpu":
+            warnings.warn("worker processes are only supported on cpu, using a single process on {} instead.".format(device))
+            workers = 0
+        key = (mode, jit, str(device), ckpt) + tuple(sorted(kwargs.items()))
+        if workers > 1:
+            key += (('workers', workers),)
+
+        with self.lock:
+            if key in self.models:
+                self.hits += 1
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            self.misses += 1
+            start = time.perf_counter()
+            if workers > 1:
+                from .pool import RemoverPool
+                remover = RemoverPool(workers=workers, mode=mode, jit=jit, device=device, ckpt=ckpt, **kwargs)
+            else:
+                remover = Remover(mode=mode, jit=jit, device=device, ckpt=ckpt, **kwargs)
+            elapsed = time.perf_counter() - start
+            self.load_time += elapsed
+
+            self.models[key] = remover
+            self.sizes[key] = self.model_size(remover)
+            self.evict()
+
+            print("InSPyReNet model loaded in {:.2f}s -> {}".format(elapsed, self.stats()))
+            return remover
+
+    def evict(self):
+        # the most recently used model always stays, even if it alone exceeds the budget
+        while len(self.models) > 1 and sum(self.sizes.values()) > self.budget:
+            key = next(iter(self.models))
+            self.close(key)
+            self.evictions += 1
+
+            if 'cuda' in key[2]:
+                torch.cuda.empty_cache()
+
+    def set_budget(self, budget):
+        """
+        Args:
+            budget (int): memory budget in MB
+        """
+        with self.lock:
+            self.budget = budget * 1024 ** 2
+            self.evict()
+
+    def close(self, key):
+        # worker processes of a pool are stopped, they start again if a node output still holding the pool is used
+        remover = self.models.pop(key)
+        del self.sizes[key]
+        if hasattr(remover, "close"):
+            remover.close()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.models):
+                self.close(key)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'load_time': round(self.load_time, 3),
+            'models': len(self.models),
+            'memory_mb': round(sum(self.sizes.values()) / 1024 ** 2, 1),
+            'budget_mb': round(self.budget / 1024 ** 2, 1),
+        }
+
+    @staticmethod
+    def model_size(remover):
+        tensors = list(remover.model.parameters()) + list(remover.model.buffers())
+        # int8 Linear weights are packed outside of parameters and buffers, and are most of the weights of SwinB
+        for key, value in remover.model.state_dict().items():
+            if key.endswith("_packed_params._packed_params"):
+                tensors += [t for t in value if torch.is_tensor(t)]
+        # a pool holds a model in every worker besides the one of this process
+        copies = 1 + getattr(remover, "workers", 0)
+        return copies * sum(t.numel() * t.element_size() for t in tensors)
+
+registry = ModelRegistry()
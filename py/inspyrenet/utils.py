@@ -1,10 +1,14 @@
 import os
 import re
 import cv2
+import glob
+import json
+import time
 import yaml
 import torch
 import hashlib
 import argparse
+import warnings
 
 import albumentations as A
 from albumentations.core.transforms_interface import ImageOnlyTransform
@@ -12,7 +16,9 @@ from albumentations.core.transforms_interface import ImageOnlyTransform
 import numpy as np
 
 from PIL import Image
-from threading import Thread
+from threading import Thread, Lock, Condition
+from collections import deque
+from packaging import version
 from easydict import EasyDict
 
 def parse_args():
@@ -26,6 +32,10 @@ def parse_args():
     parser.add_argument('--mode',      '-m',  type=str, default='base', help="choose between base and fast mode. Also, use base-nightly for nightly release checkpoint.")
     parser.add_argument('--ckpt',      '-c',  type=str, default=None,   help="Designate checkpoint. If not specified, it will download or load pre-downloaded default checkpoint.")
     parser.add_argument('--threshold', '-th', type=str, default=None,   help="Designate threshold. If specified, it will output hard prediction above threshold. If not specified, it will output soft prediction.")
+    parser.add_argument('--batch_size', '-b', type=int, default=8,     help="Number of images or consecutive video frames for a single forward pass.")
+    parser.add_argument('--workers',   '-w',  type=int, default=None,   help="Number of threads decoding and encoding images of a directory. If not specified, number of cpus up to 8.")
+    parser.add_argument('--shard',            type=str, default=None,   help="Process only one shard of a directory as index/count (e.g. 0/4), so several processes can split it.")
+    parser.add_argument('--latency',          type=float, default=None, help="Webcam capture to output latency budget in milliseconds. If specified, switches to fast sizing while the budget is exceeded.")
     return parser.parse_args()
 
 def get_backend():
@@ -36,6 +46,136 @@ def get_backend():
     else:
         return "cpu"
     
+def get_device(device=None):
+    if device is not None:
+        return device
+    elif torch.cuda.is_available():
+        return "cuda:0"
+    elif (
+        version.parse(torch.__version__) >= version.parse("1.13")
+        and torch.backends.mps.is_available()
+    ):
+        return "mps:0"
+    else:
+        return "cpu"
+
+def get_autocast_dtype(precision, device):
+    """
+    Args:
+        precision (str): fp32, bf16 or fp16
+        device (str): device for computation
+    Returns:
+        torch.dtype: dtype for autocast, None for fp32 or if the precision is not supported on the device
+    """
+    device_type = torch.device(device).type
+    if precision in ("fp32", "int8"):
+        # int8 is handled by dynamic quantization, not by autocast
+        return None
+    elif precision == "bf16":
+        if device_type == "cuda" and not torch.cuda.is_bf16_supported():
+            warnings.warn("bf16 is not supported on {}, using fp32 instead.".format(device))
+            return None
+        elif device_type == "mps":
+            warnings.warn("bf16 autocast is not supported on mps, using fp32 instead.")
+            return None
+        return torch.bfloat16
+    elif precision == "fp16":
+        if device_type == "cpu":
+            warnings.warn("fp16 autocast is not supported on cpu, using fp32 instead. use bf16 for cpu.")
+            return None
+        return torch.float16
+    else:
+        raise ValueError("Unknown precision {}. Choose among fp32, bf16, fp16 and int8.".format(precision))
+
+def fuse_state_dict(state_dict):
+    """
+    Args:
+        state_dict (dict): state dict of a model with `Conv2d` layers of conv and batch norm
+    Returns:
+        dict: state dict of the same model after `fuse_conv_bn`, batch norm statistics are folded into conv weight and bias
+    """
+    from .modules.layers import fold_batch_norm
+
+    state_dict = dict(state_dict)
+    for key in [k for k in state_dict if k.endswith(".bn.running_var")]:
+        prefix = key[:-len("bn.running_var")]
+        if prefix + "conv.weight" not in state_dict:
+            continue
+
+        bn = {name: state_dict.pop(prefix + "bn." + name, None)
+              for name in ("weight", "bias", "running_mean", "running_var", "num_batches_tracked")}
+        state_dict[prefix + "conv.weight"], state_dict[prefix + "conv.bias"] = fold_batch_norm(
+            state_dict[prefix + "conv.weight"], state_dict.get(prefix + "conv.bias"),
+            bn["weight"], bn["bias"], bn["running_mean"], bn["running_var"]
+        )
+    return state_dict
+
+def load_weights(ckpt, dtype=None, fuse=False):
+    """
+    Args:
+        ckpt (str): pickle checkpoint
+        dtype (torch.dtype, optional): pre-cast floating point weights with 2 or more dimensions (conv, linear, bias tables) to dtype
+        fuse (bool): fold batch norms into convs, for a model after `fuse_conv_bn`. folding runs before pre-casting, in float64.
+    Returns:
+        dict: state dict memory-mapped from a copy of the checkpoint converted to safetensors (or torch zip format if safetensors
+              is not installed). the conversion runs once, and is redone only if the checkpoint is newer than the converted copy.
+    """
+    try:
+        from safetensors.torch import load_file, save_file
+    except ImportError:
+        load_file = save_file = None
+
+    stem = os.path.splitext(ckpt)[0] + ("_fused" if fuse else "") + ("" if dtype is None else "_" + str(dtype).split(".")[-1])
+    if save_file is not None:
+        path = stem + ".safetensors"
+    elif version.parse(torch.__version__) >= version.parse("2.1"):
+        path = stem + "_mmap.pt"
+    else:
+        path = None
+
+    if path is None or not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(ckpt):
+        state_dict = torch.load(ckpt, map_location="cpu")
+        if fuse:
+            state_dict = fuse_state_dict(state_dict)
+        if dtype is not None:
+            state_dict = {k: v.to(dtype) if v.is_floating_point() and v.dim() >= 2 else v for k, v in state_dict.items()}
+        if path is None:
+            return state_dict
+
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        if save_file is not None:
+            save_file({k: v.contiguous() for k, v in state_dict.items()}, tmp_path)
+        else:
+            torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, path)
+        del state_dict
+
+    if load_file is not None:
+        return load_file(path, device="cpu")
+    return torch.load(path, map_location="cpu", mmap=True)
+
+def quantize_dynamic(model, ckpt):
+    """
+    Args:
+        model (torch.nn.Module): model without weights loaded
+        ckpt (str): fp32 checkpoint of the model
+    Returns:
+        torch.nn.Module: model with int8 dynamically quantized Linear layers for cpu inference.
+                         quantized weights are cached next to the checkpoint, so the fp32 checkpoint is only read once.
+    """
+    cache = "{}_int8_torch{}.pth".format(os.path.splitext(ckpt)[0], torch.__version__.split("+")[0])
+
+    if os.path.isfile(cache) and os.path.getmtime(cache) >= os.path.getmtime(ckpt):
+        # quantized layout from the unloaded model, weights from the cache
+        qmodel = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        qmodel.load_state_dict(torch.load(cache, map_location="cpu"), strict=True)
+    else:
+        model.load_state_dict(torch.load(ckpt, map_location="cpu"), strict=True)
+        qmodel = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        torch.save(qmodel.state_dict(), cache)
+
+    return qmodel
+
 def load_config(config_dir, easy=True):
     cfg = yaml.load(open(config_dir), yaml.FullLoader)
     if easy is True:
@@ -60,33 +200,223 @@ def sort(x):
     alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
     return sorted(x, key=alphanum_key)
 
+def parse_shard(shard):
+    """
+    Args:
+        shard (str): shard as "index/count", e.g. "0/4"
+    Returns:
+        tuple: index and count of the shard
+    """
+    try:
+        index, count = [int(i) for i in shard.split("/")]
+    except ValueError:
+        raise ValueError("Invalid shard {}. Use index/count, e.g. 0/4.".format(shard))
+    if not 0 <= index < count:
+        raise ValueError("Invalid shard {}. Index should be in range 0 ~ count - 1.".format(shard))
+    return index, count
+
+def in_shard(name, shard):
+    # shards are assigned by a hash of the file name, so adding or removing files does not move the others between shards
+    index, count = shard
+    return int(hashlib.md5(name.encode("utf-8")).hexdigest(), 16) % count == index
+
+class LatencyController:
+    def __init__(self, target, window=30, recover=0.5):
+        """
+        Switches between base and fast sizing of `Remover` to keep the capture to output latency under target.
+
+        Args:
+            target (float): latency budget in milliseconds
+            window (int): number of recent frames whose median latency is compared with the budget
+            recover (float): switch back to base sizing once the median latency of fast sizing is below target * recover
+        """
+        self.target = target
+        self.recover = recover
+        self.window = deque(maxlen=window)
+        self.latencies = []
+        self.sizing = "base"
+        self.switches = 0
+
+    def update(self, latency):
+        """
+        Args:
+            latency (float): capture to output latency of the last frame in milliseconds
+        Returns:
+            str: sizing for the next frame, 'base' or 'fast'
+        """
+        self.latencies.append(latency)
+        self.window.append(latency)
+        if len(self.window) < self.window.maxlen:
+            return self.sizing
+
+        median = float(np.median(self.window))
+        if self.sizing == "base" and median > self.target:
+            self.sizing = "fast"
+        elif self.sizing == "fast" and median < self.target * self.recover:
+            self.sizing = "base"
+        else:
+            return self.sizing
+
+        # latencies of the previous sizing say nothing about the new one
+        self.window.clear()
+        self.switches += 1
+        return self.sizing
+
+    def stats(self):
+        if len(self.latencies) == 0:
+            return {'frames': 0}
+        latencies = np.array(self.latencies)
+        return {
+            'frames': len(latencies),
+            'mean_ms': round(float(latencies.mean()), 1),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 1),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 1),
+            'max_ms': round(float(latencies.max()), 1),
+            'sizing': self.sizing,
+            'switches': self.switches,
+        }
+
+class Manifest:
+    def __init__(self, root, shard=None, flush_every=64):
+        """
+        Record of finished outputs in root, keyed by the input file name. each shard writes its own file and reads all of them.
+
+        Args:
+            root (str): output directory
+            shard (tuple, optional): index and count of the shard of this process
+            flush_every (int): write the manifest after this many updates, so an interrupted run loses little
+        """
+        name = ".manifest.json" if shard is None else ".manifest.{}-{}.json".format(*shard)
+        self.path = os.path.join(root, name)
+        self.flush_every = flush_every
+        self.lock = Lock()
+        self.count = 0
+
+        self.entries = {}
+        self.own = {}
+        for path in sorted(glob.glob(os.path.join(root, ".manifest*.json"))):
+            try:
+                with open(path, "r") as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, entry in entries.items():
+                self.entries.setdefault(key, []).append(entry)
+            if path == self.path:
+                self.own = entries
+
+    def done(self, name, entry):
+        """
+        Returns:
+            bool: True if name has been finished with exactly the same entry (content hash and settings)
+        """
+        return entry in self.entries.get(name, [])
+
+    def update(self, name, entry):
+        with self.lock:
+            self.own[name] = entry
+            self.entries[name] = [entry]
+            self.count += 1
+            if self.count % self.flush_every == 0:
+                self._write()
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self.own, f)
+        os.replace(tmp_path, self.path)
+
+def get_md5(path, cache_dir=None, chunk_size=1024 ** 2):
+    """
+    Args:
+        path (str): file to hash
+        cache_dir (str, optional): directory of the digest cache. digests are reused while size, mtime and inode of the file are unchanged.
+        chunk_size (int): hash the file by chunks of this size instead of reading it at once
+    Returns:
+        str: md5 hex digest of the file
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    cache, cache_file = {}, None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'md5_cache.json')
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+        if path in cache and cache[path]['signature'] == signature:
+            return cache[path]['md5']
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    digest = md5.hexdigest()
+
+    if cache_file is not None:
+        cache[path] = {'signature': signature, 'md5': digest}
+        try:
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+    return digest
+
 def download_and_unzip(filename, url, dest, unzip=True, **kwargs):
     if not os.path.isdir(dest):
         os.makedirs(dest, exist_ok=True)
     
     if os.path.isfile(os.path.join(dest, filename)) is False:
         os.system("wget -O {} {}".format(os.path.join(dest, filename), url))
-    elif 'md5' in kwargs.keys() and kwargs['md5'] != hashlib.md5(open(os.path.join(dest, filename), 'rb').read()).hexdigest():
+    elif 'md5' in kwargs.keys() and kwargs['md5'] != get_md5(os.path.join(dest, filename)):
         os.system("wget -O {} {}".format(os.path.join(dest, filename), url))
         
     if unzip:
         os.system("unzip -o {} -d {}".format(os.path.join(dest, filename), dest))
         os.system("rm {}".format(os.path.join(dest, filename)))
         
+def get_dynamic_size(size, L=1280):
+    size = list(size)
+    if (size[0] >= size[1]) and size[1] > L: 
+        size[0] = size[0] / (size[1] / L)
+        size[1] = L
+    elif (size[1] > size[0]) and size[0] > L:
+        size[1] = size[1] / (size[0] / L)
+        size[0] = L
+    return (int(round(size[0] / 32)) * 32, int(round(size[1] / 32)) * 32)
+
+BUCKET_SIZES = list(range(384, 2304 + 1, 192))
+
+# input shapes (bucket and batch size) compiled with torch.compile per model, others run eagerly
+COMPILE_CACHE_SIZE = 32
+
+def get_bucket_size(size):
+    """
+    Args:
+        size (tuple): height and width
+    Returns:
+        tuple: height and width snapped to the nearest bucket. buckets are multiples of 192, which is a multiple of
+               the model stride (32) and the SwinB window of 12 patches of 4 pixels, so there is no window padding in early stages.
+    """
+    return tuple(min(BUCKET_SIZES, key=lambda b: abs(b - s)) for s in size)
+
 class dynamic_resize:
     def __init__(self, L=1280): 
         self.L = L
                     
     def __call__(self, img):
-        size = list(img.size)
-        if (size[0] >= size[1]) and size[1] > self.L: 
-            size[0] = size[0] / (size[1] / self.L)
-            size[1] = self.L
-        elif (size[1] > size[0]) and size[0] > self.L:
-            size[1] = size[1] / (size[0] / self.L)
-            size[0] = self.L
-        size = (int(round(size[0] / 32)) * 32, int(round(size[1] / 32)) * 32)
-    
+        size = get_dynamic_size(img.size, self.L)
         return img.resize(size, Image.BILINEAR)
 
 class dynamic_resize_a(ImageOnlyTransform):
@@ -95,15 +425,7 @@ class dynamic_resize_a(ImageOnlyTransform):
         self.L = L
 
     def apply(self, img, **params):
-        size = list(img.shape[:2])
-        if (size[0] >= size[1]) and size[1] > self.L: 
-            size[0] = size[0] / (size[1] / self.L)
-            size[1] = self.L
-        elif (size[1] > size[0]) and size[0] > self.L:
-            size[1] = size[1] / (size[0] / self.L)
-            size[0] = self.L
-        size = (int(round(size[0] / 32)) * 32, int(round(size[1] / 32)) * 32)
-
+        size = get_dynamic_size(img.shape[:2], self.L)
         return A.resize(img, height=size[0], width=size[1])
 
     def get_transform_init_args_names(self):
@@ -214,13 +536,27 @@ class VideoLoader:
         return self.size
     
 class WebcamLoader:
-    def __init__(self, ID):
+    def __init__(self, ID, buffer_size=2):
+        """
+        Args:
+            ID (int): camera index
+            buffer_size (int): number of frames kept by the capture thread. only the latest frame is returned,
+                               older ones are dropped instead of piling up when inference is slower than capture.
+        """
         self.ID = int(ID)
         self.cap = cv2.VideoCapture(self.ID)
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        self.imgs = []
-        self.imgs.append(self.cap.read()[1])
+        self.imgs = deque(maxlen=buffer_size)
+        self.lock = Lock()
+        # signaled by the capture thread on every frame and when it stops
+        self.ready = Condition(self.lock)
+        self.stopped = False
+        self.dropped = 0
+        self.timestamp = None
+        ret, frame = self.cap.read()
+        if ret is True:
+            self.imgs.append((time.perf_counter(), frame))
         self.thread = Thread(target=self.update, daemon=True)
         self.thread.start()
         
@@ -228,28 +564,38 @@ class WebcamLoader:
         while self.cap.isOpened():
             ret, frame = self.cap.read()
             if ret is True:
-                self.imgs.append(frame)
+                with self.ready:
+                    if len(self.imgs) == self.imgs.maxlen:
+                        self.dropped += 1
+                    self.imgs.append((time.perf_counter(), frame))
+                    self.ready.notify()
             else:
                 break
+
+        with self.ready:
+            self.stopped = True
+            self.ready.notify()
         
     def __iter__(self):
         return self
 
     def __next__(self):
-        if len(self.imgs) > 0:
-            frame = self.imgs[-1]
-        else:
-            frame = Image.fromarray(np.zeros((480, 640, 3)).astype(np.uint8))
-            
-        if self.thread.is_alive() is False or cv2.waitKey(1) == ord('q'):
+        frame = None
+        with self.ready:
+            # sleeps until the capture thread has a frame, instead of polling for it
+            self.ready.wait_for(lambda: len(self.imgs) > 0 or self.stopped)
+            if len(self.imgs) > 0:
+                # latest frame semantics, frames captured while the previous one was processed are dropped
+                self.dropped += len(self.imgs) - 1
+                self.timestamp, frame = self.imgs[-1]
+                self.imgs.clear()
+
+        if frame is None or cv2.waitKey(1) == ord('q'):
             cv2.destroyAllWindows()
             raise StopIteration
-        
-        else:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = Image.fromarray(frame).convert('RGB')
-        
-        del self.imgs[:-1]
+
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frame = Image.fromarray(frame).convert('RGB')
         return frame, None
 
     def __len__(self):
@@ -0,0 +1,35 @@
+"""
+Entry point of `RemoverPool` worker processes. it is run with runpy as `inspyrenet.worker`, a top-level package imported
+from the py directory, so that workers do not import the ComfyUI plugin package and every node with it.
+"""
+import traceback
+
+import torch
+
+def main(kwargs, threads, tasks, results):
+    """
+    Args:
+        kwargs (dict): keyword arguments of `Remover` for the model of this worker
+        threads (int): intra-op thread budget of this worker
+        tasks (Queue): (index, method, args, kwargs) of `Remover` calls, None to stop
+        results (Queue): (index, output, error) of each task, error is a formatted traceback or None
+    """
+    torch.set_num_threads(threads)
+    from inspyrenet.Remover import Remover
+
+    remover = Remover(**kwargs)
+    results.put((None, None, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        index, method, args, kw = task
+        try:
+            results.put((index, getattr(remover, method)(*args, **kw), None))
+        except Exception:
+            results.put((index, None, traceback.format_exc()))
+
+if __name__ == "__main__":
+    main(**WORKER_ARGS)  # noqa: F821, passed by RemoverPool through runpy init_globals